@@ -0,0 +1,270 @@
+"""
+Benchmarks for csvs-to-sqlite, run against synthetic CSV files.
+
+    python benchmarks/benchmark.py --rows 200000 --save baseline.json
+    python benchmarks/benchmark.py --rows 200000 --compare baseline.json
+
+Each scenario is run in a fresh process with --stats-json, so the rows per
+second and peak memory use of one scenario cannot affect the next.
+"""
+
+import click
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+WORDS = (
+    "apple banana cherry delta echo foxtrot golf hotel india juliet kilo lima "
+    "mike november oscar papa quebec romeo sierra tango uniform victor whiskey "
+    "xray yankee zulu"
+).split()
+
+# Only written when the encoding can represent them, to exercise detection
+ACCENTED_WORDS = ["café", "naïve", "señor", "über", "façade"]
+
+
+def generate_csv(
+    path,
+    rows,
+    columns=10,
+    cardinality=100,
+    date_format="%Y-%m-%d",
+    encoding="utf8",
+    null_ratio=0.0,
+    separator=",",
+    seed=0,
+):
+    """
+    Writes a CSV file with these columns, followed by int_N, float_N and
+    text_N columns until there are the requested number of columns:
+
+    - id: the row number
+    - category: one of cardinality distinct values, for --extract-column
+    - name: a short phrase that is nearly always unique, for --fts
+    - date: a date in date_format, for --date
+
+    Every column other than id is left empty for null_ratio of the rows.
+    """
+    rng = random.Random(seed)
+    words = WORDS + ACCENTED_WORDS if encoding != "ascii" else WORDS
+    categories = [
+        "{} {}".format(rng.choice(words), i) for i in range(max(cardinality, 1))
+    ]
+    headers = ["id", "category", "name", "date"]
+    for i in range(max(columns - len(headers), 0)):
+        headers.append("{}_{}".format(("int", "float", "text")[i % 3], i))
+    headers = headers[:columns]
+    start = datetime.date(2000, 1, 1)
+
+    def value(header, row):
+        if header == "id":
+            return str(row)
+        if null_ratio and rng.random() < null_ratio:
+            return ""
+        if header == "category":
+            return categories[rng.randrange(len(categories))]
+        elif header == "name":
+            return "{} {} {}".format(
+                rng.choice(words), rng.choice(words), rng.randrange(rows * 10)
+            )
+        elif header == "date":
+            date = start + datetime.timedelta(days=rng.randrange(10000))
+            return date.strftime(date_format)
+        elif header.startswith("int_"):
+            return str(rng.randrange(1000000))
+        elif header.startswith("float_"):
+            return "{:.3f}".format(rng.random() * 1000)
+        else:
+            return categories[rng.randrange(len(categories))] + " text"
+
+    with open(path, "w", encoding=encoding, newline="") as fp:
+        fp.write(separator.join(headers) + "\n")
+        for row in range(rows):
+            cells = [value(header, row) for header in headers]
+            fp.write(
+                separator.join(
+                    '"{}"'.format(cell) if separator in cell else cell for cell in cells
+                )
+                + "\n"
+            )
+    return headers
+
+
+# name: (number of files, generate_csv() options, csvs-to-sqlite options)
+SCENARIOS = {
+    "plain": (1, {}, []),
+    "extract-column": (1, {"cardinality": 1000}, ["-c", "category"]),
+    "fts": (1, {}, ["-f", "name"]),
+    "date": (1, {"date_format": "%d/%m/%Y"}, ["-d", "date"]),
+    "shape": (1, {}, ["--shape", "id,category,name:title,int_0(REAL)"]),
+    "directory": (8, {}, []),
+    "latin-1": (1, {"encoding": "latin-1"}, []),
+    "nulls": (1, {"null_ratio": 0.3}, []),
+}
+
+
+def run_scenario(name, rows, columns, data_dir, extra_args=()):
+    """
+    Imports the scenario's CSVs, generating them first if they are not in
+    data_dir already. Returns the time taken, rows per second and peak memory
+    use, along with the time spent in each stage of the import.
+    """
+    files, csv_options, args = SCENARIOS[name]
+    scenario_dir = os.path.join(data_dir, "{}-{}-{}".format(name, rows, columns))
+    if not os.path.exists(scenario_dir):
+        os.makedirs(scenario_dir)
+        for i in range(files):
+            generate_csv(
+                os.path.join(scenario_dir, "file_{}.csv".format(i)),
+                rows // files,
+                columns=columns,
+                seed=i,
+                **csv_options
+            )
+    db_path = os.path.join(data_dir, "{}.db".format(name))
+    stats_path = os.path.join(data_dir, "{}.json".format(name))
+    for path in (db_path, stats_path):
+        if os.path.exists(path):
+            os.remove(path)
+    # A new process for each run, so peak memory use is just this scenario's
+    subprocess.run(
+        [sys.executable, "-c", "from csvs_to_sqlite.cli import cli; cli()"]
+        + [scenario_dir, db_path, "--stats-json", stats_path]
+        + list(args)
+        + list(extra_args),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    with open(stats_path) as fp:
+        stats = json.load(fp)
+    os.remove(db_path)
+    return {
+        "rows": rows // files * files,
+        "seconds": stats["total_seconds"],
+        "rows_per_second": rows // files * files / stats["total_seconds"],
+        "peak_rss": stats["peak_rss"],
+        "stages": {stage["stage"]: stage["seconds"] for stage in stats["stages"]},
+    }
+
+
+def compare(results, baseline, threshold):
+    "Returns (lines describing the results, names of scenarios that regressed)"
+    lines = [
+        "{:<16} {:>10} {:>12} {:>10} {:>10}".format(
+            "Scenario", "Seconds", "Rows/sec", "Peak MB", "Change"
+        )
+    ]
+    regressions = []
+    for name, result in results.items():
+        change = ""
+        previous = baseline.get(name)
+        if previous is not None and previous["rows"] == result["rows"]:
+            ratio = result["rows_per_second"] / previous["rows_per_second"] - 1
+            change = "{:+.1%}".format(ratio)
+            if ratio < -threshold:
+                regressions.append(name)
+                change += " !"
+        lines.append(
+            "{:<16} {:>10.3f} {:>12,.0f} {:>10} {:>10}".format(
+                name,
+                result["seconds"],
+                result["rows_per_second"],
+                (
+                    "-"
+                    if result["peak_rss"] is None
+                    else "{:.1f}".format(result["peak_rss"] / 1024 / 1024)
+                ),
+                change,
+            )
+        )
+    return lines, regressions
+
+
+@click.command()
+@click.option("--rows", default=100000, help="Number of rows in each scenario")
+@click.option("--columns", default=10, help="Number of columns in each CSV")
+@click.option(
+    "scenarios",
+    "--scenario",
+    "-s",
+    multiple=True,
+    type=click.Choice(list(SCENARIOS)),
+    help="Scenario to run - defaults to all of them",
+)
+@click.option(
+    "--repeat", default=1, help="Run each scenario this many times and keep the best"
+)
+@click.option(
+    "--data-dir",
+    type=click.Path(file_okay=False),
+    help="Keep the generated CSVs here, to reuse them next time",
+)
+@click.option(
+    "--save", type=click.Path(dir_okay=False), help="Save the results as a baseline"
+)
+@click.option(
+    "compare_with",
+    "--compare",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Compare the results against a saved baseline",
+)
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Fail if rows/sec is this much lower than the baseline",
+)
+@click.argument("extra_args", nargs=-1, type=click.UNPROCESSED)
+def cli(
+    rows,
+    columns,
+    scenarios,
+    repeat,
+    data_dir,
+    save,
+    compare_with,
+    threshold,
+    extra_args,
+):
+    """
+    Time the main csvs-to-sqlite scenarios against synthetic CSVs
+
+    Any EXTRA_ARGS after -- are passed to every csvs-to-sqlite run, for
+    example: -- --fast --chunk-size 10000
+    """
+    keep_data = data_dir is not None
+    if not keep_data:
+        data_dir = tempfile.mkdtemp(prefix="csvs-to-sqlite-benchmark-")
+    results = {}
+    try:
+        for name in scenarios or SCENARIOS:
+            runs = [
+                run_scenario(name, rows, columns, data_dir, extra_args)
+                for _ in range(repeat)
+            ]
+            results[name] = max(runs, key=lambda run: run["rows_per_second"])
+    finally:
+        if not keep_data:
+            shutil.rmtree(data_dir)
+    baseline = {}
+    if compare_with:
+        with open(compare_with) as fp:
+            baseline = json.load(fp)
+    lines, regressions = compare(results, baseline, threshold)
+    for line in lines:
+        click.echo(line)
+    if save:
+        with open(save, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if regressions:
+        raise click.ClickException(
+            "Slower than the baseline: {}".format(", ".join(regressions))
+        )
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,21 +2,50 @@ from __future__ import absolute_import
 
 import click
 from .utils import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_ENCODINGS,
+    DEFAULT_LOOKUP_MEMORY_BUDGET,
+    ENGINES,
+    FAST_PRAGMAS,
+    ImportStats,
     LoadCsvError,
     LookupTable,
     PathOrURL,
-    add_index,
-    apply_dates_and_datetimes,
-    apply_shape,
+    ProgressReporter,
+    add_indexes,
+    apply_pragmas,
     best_fts_version,
+    concurrent_readers,
+    copy_fts_from_database,
+    create_table_with_foreign_keys,
+    csv_size,
     csvs_from_paths,
+    delete_rows,
+    ensure_files_table,
     generate_and_populate_fts,
+    insert_dataframe,
+    load_and_prepare_csvs_in_parallel,
     load_csv,
+    parse_pragma,
+    plan_columns,
+    plan_incremental_import,
+    populate_fts_in_separate_database,
+    pyarrow_available,
+    read_csv_header,
+    prepare_dataframe,
     refactor_dataframes,
+    restore_pragmas,
+    save_file_record,
+    shape_type_overrides,
+    sqlite_capabilities,
     table_exists,
     drop_table,
     to_sql_with_foreign_keys,
+    upsert_dataframe,
 )
+import concurrent.futures
+import copy
+import json
 import os
 import sqlite3
 
@@ -99,6 +128,12 @@ import sqlite3
     help="Custom shape for the DB table - format is csvcol:dbcol(TYPE),...",
     default=None,
 )
+@click.option(
+    "exclude_columns",
+    "--exclude-column",
+    multiple=True,
+    help="Skip this column of the CSV files, without parsing it",
+)
 @click.option(
     "--filename-column",
     help="Add a column with this name and populate with CSV file name",
@@ -145,6 +180,140 @@ import sqlite3
     is_flag=True,
     help="Import all columns as text strings by default (and, if specified, still obey --shape, --date/datetime, and --datetime-format)",
 )
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Stream each CSV in chunks of this many rows, to keep memory use bounded",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(ENGINES),
+    default="c",
+    help=(
+        "CSV parser to use - pyarrow is multithreaded and keeps columns in "
+        "Arrow format, but needs pyarrow to be installed"
+    ),
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help=(
+        "Use less memory while loading, by storing numbers in smaller types "
+        "and text that repeats as categories"
+    ),
+)
+@click.option(
+    "--fast",
+    is_flag=True,
+    help=(
+        "Speed up the import by turning off SQLite journaling and sync "
+        "(the database may be corrupted if the import is interrupted)"
+    ),
+)
+@click.option(
+    "pragmas",
+    "--pragma",
+    multiple=True,
+    help="Set a SQLite PRAGMA for the duration of the import, e.g. cache_size=-100000",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes to use for parsing CSV files",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help=(
+        "Skip CSV files that have not changed since the last --incremental "
+        "import, and replace the rows from files that have"
+    ),
+)
+@click.option(
+    "--append-only",
+    is_flag=True,
+    help=(
+        "Implies --incremental. Files that have only had rows added to the "
+        "end since the last import have just those new rows imported"
+    ),
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help=(
+        "Update rows already in the table that have the same --primary-key, "
+        "instead of adding duplicates"
+    ),
+)
+@click.option(
+    "--type-sample",
+    type=click.IntRange(min=1),
+    default=None,
+    help=(
+        "Only check this many rows of each new table when deciding if a "
+        "column of numbers with gaps should be INTEGER rather than REAL"
+    ),
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of rows to insert per executemany() call",
+)
+@click.option(
+    "--index-jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "Number of worker processes to use for building full-text indexes, "
+        "which are built alongside the other indexes"
+    ),
+)
+@click.option(
+    "--lookup-cache-mb",
+    type=click.IntRange(min=0),
+    default=DEFAULT_LOOKUP_MEMORY_BUDGET // 1024 // 1024,
+    show_default=True,
+    help=(
+        "Memory in MB each --extract-column lookup table can use to hold "
+        "its values in memory - larger tables are looked up using an index"
+    ),
+)
+@click.option(
+    "--lookup-cache-size",
+    type=click.IntRange(min=0),
+    default=None,
+    help=(
+        "Maximum number of values to hold in memory for each lookup table, "
+        "as well as the --lookup-cache-mb limit"
+    ),
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    help=(
+        "Show progress bars with throughput and time remaining, or log "
+        "progress every 10 seconds if output is not a terminal"
+    ),
+)
+@click.option(
+    "--stats",
+    is_flag=True,
+    help=(
+        "Print the time taken and rows processed by each stage of the "
+        "import, and the peak memory use so far"
+    ),
+)
+@click.option(
+    "--stats-json",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the same statistics as --stats to this file as JSON",
+)
 @click.version_option()
 def cli(
     paths,
@@ -162,6 +331,7 @@ def cli(
     fts,
     index,
     shape,
+    exclude_columns,
     filename_column,
     fixed_columns,
     fixed_columns_int,
@@ -169,12 +339,31 @@ def cli(
     no_index_fks,
     no_fulltext_fks,
     just_strings,
+    chunk_size,
+    engine,
+    compact,
+    fast,
+    pragmas,
+    jobs,
+    incremental,
+    append_only,
+    upsert,
+    type_sample,
+    batch_size,
+    index_jobs,
+    lookup_cache_mb,
+    lookup_cache_size,
+    progress,
+    stats,
+    stats_json,
 ):
     """
-    PATHS: paths to individual .csv files or to directories containing .csvs
+    PATHS: paths to individual .csv files (optionally compressed) or to
+    directories or .zip files containing .csvs
 
     DBNAME: name of the SQLite database file to create
     """
+    import_stats = ImportStats()
     # make plural for more readable code:
     extract_columns = extract_column
     del extract_column
@@ -186,45 +375,56 @@ def cli(
     if "." not in dbname:
         dbname += ".db"
 
-    db_existed = os.path.exists(dbname)
+    if jobs > 1 and chunk_size:
+        raise click.BadParameter(
+            "--jobs cannot be combined with --chunk-size", param_hint="--jobs"
+        )
 
-    conn = sqlite3.connect(dbname)
+    if engine == "pyarrow":
+        if not pyarrow_available():
+            raise click.BadParameter(
+                "pyarrow is not installed - try: pip install pyarrow",
+                param_hint="--engine",
+            )
+        if chunk_size:
+            raise click.BadParameter(
+                "--engine pyarrow cannot be combined with --chunk-size",
+                param_hint="--engine",
+            )
 
-    dataframes = []
-    csvs = csvs_from_paths(paths)
-    sql_type_overrides = None
-    for name, path in csvs.items():
-        try:
-            df = load_csv(
-                path, separator, skip_errors, quoting, shape, just_strings=just_strings
+    incremental = incremental or append_only
+    if incremental and replace_tables:
+        raise click.BadParameter(
+            "--incremental cannot be combined with --replace-tables",
+            param_hint="--incremental",
+        )
+
+    if upsert:
+        if not primary_key:
+            raise click.BadParameter(
+                "--upsert needs --primary-key", param_hint="--upsert"
+            )
+        if replace_tables:
+            raise click.BadParameter(
+                "--upsert cannot be combined with --replace-tables",
+                param_hint="--upsert",
+            )
+        if not sqlite_capabilities().upsert:
+            raise click.BadParameter(
+                "Your SQLite version does not support upserts", param_hint="--upsert"
             )
-            df.table_name = table or name
-            if filename_column:
-                df[filename_column] = name
-                if shape:
-                    shape += ",{}".format(filename_column)
-            if fixed_columns:
-                for colname, value in fixed_columns:
-                    df[colname] = value
-                    if shape:
-                        shape += ",{}".format(colname)
-            if fixed_columns_int:
-                for colname, value in fixed_columns_int:
-                    df[colname] = value
-                    if shape:
-                        shape += ",{}".format(colname)
-            if fixed_columns_float:
-                for colname, value in fixed_columns_float:
-                    df[colname] = value
-                    if shape:
-                        shape += ",{}".format(colname)
-            sql_type_overrides = apply_shape(df, shape)
-            apply_dates_and_datetimes(df, date, datetime, datetime_format)
-            dataframes.append(df)
-        except LoadCsvError as e:
-            click.echo("Could not load {}: {}".format(path, e), err=True)
-
-    click.echo("Loaded {} dataframes".format(len(dataframes)))
+
+    pragmas_to_apply = list(FAST_PRAGMAS) if fast else []
+    for pragma in pragmas:
+        try:
+            pragmas_to_apply.append(parse_pragma(pragma))
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--pragma")
+
+    db_existed = os.path.exists(dbname)
+
+    conn = sqlite3.connect(dbname)
+    previous_pragmas = apply_pragmas(conn, pragmas_to_apply)
 
     # Use extract_columns to build a column:(table,label) dictionary
     foreign_keys = {}
@@ -237,34 +437,384 @@ def cli(
         else:
             foreign_keys[bits[0]] = (bits[0], "value")
 
-    # Now we have loaded the dataframes, we can refactor them
+    # Columns we add ourselves need to survive apply_shape()
+    fixed_column_values = (
+        list(fixed_columns) + list(fixed_columns_int) + list(fixed_columns_float)
+    )
+    full_shape = shape
+    if shape:
+        extra_columns = [colname for colname, _ in fixed_column_values]
+        if filename_column:
+            extra_columns.insert(0, filename_column)
+        full_shape = ",".join([shape] + extra_columns)
+    sql_type_overrides = shape_type_overrides(full_shape)
+
+    # Check up front that the columns other options use will be parsed
+    try:
+        plan_columns(
+            shape,
+            exclude_columns,
+            needed={
+                "--extract-column": list(foreign_keys),
+                "--date": date,
+                "--datetime": datetime,
+                "--primary-key": primary_key,
+                "--fts": fts,
+                "--index": [
+                    column.strip() for columns in index for column in columns.split(",")
+                ],
+            },
+            added_columns=[filename_column]
+            + [colname for colname, _ in fixed_column_values],
+        )
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    load_kwargs = dict(
+        separator=separator,
+        skip_errors=skip_errors,
+        quoting=quoting,
+        shape=shape,
+        exclude_columns=exclude_columns,
+        just_strings=just_strings,
+        engine=engine,
+        compact=compact,
+    )
+    prepare_kwargs = dict(
+        filename_column=filename_column,
+        fixed_columns=fixed_column_values,
+        shape=full_shape,
+        date_cols=date,
+        datetime_cols=datetime,
+        datetime_formats=datetime_format,
+    )
+
+    def label(df, name):
+        df.table_name = table or name
+        df.attrs["csv_name"] = name
+        return df
+
+    def prepare(df, name):
+        with import_stats.stage("apply_dates_and_datetimes", name) as counts:
+            counts["rows"] = len(df)
+            return label(prepare_dataframe(df, name, **prepare_kwargs), name)
+
+    def timed_chunks(chunks, name):
+        # Time spent waiting for the next chunk is time spent in load_csv
+        while True:
+            with import_stats.stage("load_csv", name) as counts:
+                df = next(chunks, None)
+                if df is None:
+                    return
+                counts["rows"] = len(df)
+            yield df
+
+    def report_encoding(df, path):
+        click.echo("Reading {} as {}".format(path, df.attrs["encoding"]))
+
+    csvs = csvs_from_paths(paths)
+    file_records_to_save = {}
+    if incremental:
+        ensure_files_table(conn)
+        (
+            csvs_to_import,
+            file_records_to_save,
+            tables_to_drop,
+            partitions_to_delete,
+        ) = plan_incremental_import(
+            conn, csvs, table, filename_column, append_only=append_only
+        )
+        skipped = len(csvs) - len(csvs_to_import)
+        if skipped:
+            click.echo(
+                "Skipping {} unchanged CSV file{}".format(
+                    skipped, "" if skipped == 1 else "s"
+                )
+            )
+        for name, record in file_records_to_save.items():
+            if append_only and (record["offset"] or record["size"]) < record["size"]:
+                click.echo(
+                    "Leaving the unfinished last line of {} for the next "
+                    "import".format(csvs[name])
+                )
+        for table_name in tables_to_drop:
+            drop_table(conn, table_name)
+        for table_name, names in partitions_to_delete.items():
+            delete_rows(conn, table_name, filename_column, names)
+        csvs = csvs_to_import
+
+    sizes = [csv_size(path) for path in csvs.values()]
+    # With --chunk-size or --jobs, files are read and written at the same time
+    streaming = bool(chunk_size) or jobs > 1
+    reading = ProgressReporter(
+        "Importing" if streaming else "Reading",
+        None if None in sizes else sum(sizes),
+        unit="bytes",
+        enabled=progress,
+    )
+
+    lookup_tables = {}
+    written_tables = set()
     created_tables = {}
-    refactored = refactor_dataframes(
-        conn, dataframes, foreign_keys, not no_fulltext_fks
+    indexes = {}
+    fts_tables_to_rebuild = {}
+    row_counts = {}
+    # {table_name: [inserted, updated, unchanged]} for --upsert
+    upsert_counts = {}
+    encodings = {}
+    date_stats = {}
+    # Everything that writing a file's rows adds to, so that it can be put
+    # back if the file fails part way through
+    import_state = (
+        written_tables,
+        created_tables,
+        indexes,
+        fts_tables_to_rebuild,
+        row_counts,
+        upsert_counts,
+        encodings,
     )
-    for df in refactored:
-        # This is a bit trickier because we need to
-        # create the table with extra SQL for foreign keys
-        if replace_tables and table_exists(conn, df.table_name):
-            drop_table(conn, df.table_name)
-        if table_exists(conn, df.table_name):
-            df.to_sql(df.table_name, conn, if_exists="append", index=False)
+
+    def begin_file():
+        conn.execute("SAVEPOINT import_file")
+        return copy.deepcopy(import_state)
+
+    def end_file(saved, failed=False):
+        if failed:
+            conn.execute("ROLLBACK TO import_file")
+            for current, previous in zip(import_state, saved):
+                current.clear()
+                current.update(previous)
+            # Cached ids may belong to lookup rows that were rolled back
+            lookup_tables.clear()
+        conn.execute("RELEASE import_file")
+
+    failed_names = set()
+    if chunk_size:
+        # Each chunk is refactored and written before the next is read, inside
+        # a savepoint so that a file which fails part way through is undone
+        def iter_batches():
+            for (name, path), size in zip(csvs.items(), sizes):
+                position = 0
+                encodings_to_try = DEFAULT_ENCODINGS
+                while True:
+                    saved = begin_file()
+                    encoding = None
+                    try:
+                        chunks = load_csv(
+                            path,
+                            chunksize=chunk_size,
+                            encodings_to_try=encodings_to_try,
+                            **load_kwargs
+                        )
+                        for df in timed_chunks(chunks, name):
+                            if encoding is None:
+                                encoding = df.attrs["encoding"]
+                                report_encoding(df, path)
+                            bytes_read = df.attrs["bytes_read"]
+                            # A retried file does not move the progress bar
+                            # until it gets past where the last attempt failed
+                            if bytes_read is not None and bytes_read > position:
+                                reading.update(bytes_read - position)
+                                position = bytes_read
+                            yield [prepare(df, name)]
+                    except LoadCsvError as e:
+                        end_file(saved, failed=True)
+                        if isinstance(e.__cause__, UnicodeDecodeError) and (
+                            encoding in encodings_to_try[:-1]
+                        ):
+                            # Start the file again with the next encoding
+                            encodings_to_try = encodings_to_try[
+                                encodings_to_try.index(encoding) + 1 :
+                            ]
+                            click.echo(
+                                "Could not read {} as {}, starting again".format(
+                                    path, encoding
+                                ),
+                                err=True,
+                            )
+                            continue
+                        click.echo("Could not load {}: {}".format(path, e), err=True)
+                        failed_names.add(name)
+                    else:
+                        end_file(saved)
+                    break
+                reading.update(max((size or 0) - position, 0))
+
+        batches = iter_batches()
+    elif jobs > 1:
+
+        def iter_batches():
+            for name, path, df, error in load_and_prepare_csvs_in_parallel(
+                csvs, jobs, load_kwargs, prepare_kwargs
+            ):
+                reading.update(csv_size(path) or 0)
+                if error is not None:
+                    click.echo("Could not load {}: {}".format(path, error), err=True)
+                    failed_names.add(name)
+                    continue
+                report_encoding(df, path)
+                for stage, seconds in df.attrs["timings"].items():
+                    import_stats.add(stage, name, seconds, len(df))
+                yield [label(df, name)]
+
+        batches = iter_batches()
+    else:
+        dataframes = []
+        for (name, path), size in zip(csvs.items(), sizes):
+            try:
+                with import_stats.stage("load_csv", name) as counts:
+                    df = load_csv(path, **load_kwargs)
+                    counts["rows"] = len(df)
+                report_encoding(df, path)
+                dataframes.append(prepare(df, name))
+            except LoadCsvError as e:
+                click.echo("Could not load {}: {}".format(path, e), err=True)
+                failed_names.add(name)
+            reading.update(size or 0)
+        reading.finish()
+
+        click.echo("Loaded {} dataframes".format(len(dataframes)))
+        batches = [dataframes]
+
+    for dataframes in batches:
+        for df in dataframes:
+            for column, (distinct, slow) in df.attrs.get("date_stats", {}).items():
+                totals = date_stats.setdefault(column, [0, 0])
+                totals[0] += distinct
+                totals[1] += slow
+        if streaming:
+            # Shown as running totals alongside the bytes read so far
+            def report_lookups(n):
+                reading.count("lookup values", n)
+
+            def report_inserts(n):
+                reading.count("rows inserted", n)
+
         else:
-            to_sql_with_foreign_keys(
+            lookups = ProgressReporter(
+                "Extracting",
+                sum(
+                    len(df)
+                    for df in dataframes
+                    for column in foreign_keys
+                    if column in df.columns
+                ),
+                unit="values",
+                enabled=progress,
+            )
+            inserts = ProgressReporter(
+                "Inserting", sum(len(df) for df in dataframes), enabled=progress
+            )
+            report_lookups = lookups.update
+            report_inserts = inserts.update
+        with import_stats.stage("refactor_dataframes") as counts:
+            refactored = refactor_dataframes(
                 conn,
-                df,
-                df.table_name,
+                dataframes,
                 foreign_keys,
-                sql_type_overrides,
-                primary_keys=primary_key,
-                index_fks=not no_index_fks,
+                not no_fulltext_fks,
+                lookup_tables=lookup_tables,
+                progress=report_lookups,
+                memory_budget=lookup_cache_mb * 1024 * 1024,
+                max_entries=lookup_cache_size,
             )
-            created_tables[df.table_name] = df
-        if index:
-            for index_defn in index:
-                add_index(conn, df.table_name, index_defn)
+            counts["rows"] = sum(len(df) for df in dataframes)
+        if not streaming:
+            lookups.finish()
+        for df in refactored:
+            first_write = df.table_name not in written_tables
+            written_tables.add(df.table_name)
+            name = df.attrs["csv_name"]
+            row_counts[name] = row_counts.get(name, 0) + len(df)
+            encodings[name] = df.attrs["encoding"]
+            fts_table = "{}_fts".format(df.table_name)
+            if (
+                first_write
+                and (incremental or upsert)
+                and fts
+                and table_exists(conn, fts_table)
+            ):
+                # Rows are changing, so the full-text index will be rebuilt
+                drop_table(conn, fts_table)
+                fts_tables_to_rebuild[df.table_name] = list(df.columns)
+            # This is a bit trickier because we need to
+            # create the table with extra SQL for foreign keys
+            if first_write and replace_tables and table_exists(conn, df.table_name):
+                drop_table(conn, df.table_name)
+            new_table = not table_exists(conn, df.table_name)
+            if upsert:
+                with import_stats.stage("insert_rows", name) as counts:
+                    if new_table:
+                        # Created first so that rows repeating a key replace
+                        # each other rather than failing the UNIQUE constraint
+                        create_table_with_foreign_keys(
+                            conn,
+                            df,
+                            df.table_name,
+                            foreign_keys,
+                            sql_type_overrides,
+                            primary_keys=primary_key,
+                            type_sample_size=type_sample,
+                        )
+                    try:
+                        upserted = upsert_dataframe(
+                            conn,
+                            df,
+                            df.table_name,
+                            primary_key,
+                            batch_size=batch_size,
+                            progress=report_inserts,
+                        )
+                    except sqlite3.OperationalError as e:
+                        conn.close()
+                        raise click.ClickException(
+                            "Could not upsert into {}: {}".format(df.table_name, e)
+                        )
+                    counts["rows"] = len(df)
+                totals = upsert_counts.setdefault(df.table_name, [0, 0, 0])
+                for i, count in enumerate(upserted):
+                    totals[i] += count
+            elif not new_table:
+                with import_stats.stage("insert_rows", name) as counts:
+                    insert_dataframe(
+                        conn,
+                        df,
+                        df.table_name,
+                        batch_size=batch_size,
+                        progress=report_inserts,
+                    )
+                    counts["rows"] = len(df)
+            else:
+                with import_stats.stage("insert_rows", name) as counts:
+                    to_sql_with_foreign_keys(
+                        conn,
+                        df,
+                        df.table_name,
+                        foreign_keys,
+                        sql_type_overrides,
+                        primary_keys=primary_key,
+                        type_sample_size=type_sample,
+                        batch_size=batch_size,
+                        progress=report_inserts,
+                    )
+                    counts["rows"] = len(df)
+            if new_table:
+                created_tables[df.table_name] = list(df.columns)
+                if not no_index_fks:
+                    indexes.setdefault(df.table_name, []).extend(
+                        column for column in foreign_keys if column in df.columns
+                    )
+            if first_write and index:
+                indexes.setdefault(df.table_name, []).extend(index)
+        if not streaming:
+            inserts.finish()
+    reading.finish()
 
-    # Create FTS tables
+    for lookup_table in lookup_tables.values():
+        import_stats.add_lookup_cache(lookup_table.table_name, lookup_table.cache)
+
+    fts_tables = dict(created_tables, **fts_tables_to_rebuild)
     if fts:
         fts_version = best_fts_version()
         if not fts_version:
@@ -273,26 +823,147 @@ def cli(
                 "Your SQLite version does not support any variant of FTS"
             )
         # Check that columns make sense
-        for table, df in created_tables.items():
+        for table, columns in fts_tables.items():
             for fts_column in fts:
-                if fts_column not in df.columns:
+                if fts_column not in columns:
                     raise click.BadParameter(
                         'FTS column "{}" does not exist'.format(fts_column)
                     )
+    else:
+        fts_tables = {}
+
+    def build_indexes():
+        # Indexes are built once all of the rows are in place
+        for table_name, table_indexes in indexes.items():
+            if not table_indexes:
+                continue
+            with import_stats.stage("add_indexes", table_name):
+                add_indexes(conn, table_name, table_indexes)
+
+    if index_jobs > 1 and fts_tables:
+        # Full-text indexes are built in worker processes, each into its own
+        # database file, while this process builds the other indexes
+        with concurrent_readers(conn):
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=index_jobs
+            ) as executor:
+                futures = [
+                    (
+                        table_name,
+                        executor.submit(
+                            populate_fts_in_separate_database,
+                            dbname,
+                            table_name,
+                            fts,
+                            foreign_keys,
+                            os.path.dirname(os.path.abspath(dbname)),
+                        ),
+                    )
+                    for table_name in fts_tables
+                ]
+                build_indexes()
+                conn.commit()
+                for table_name, future in futures:
+                    with import_stats.stage(
+                        "generate_and_populate_fts", table_name
+                    ) as counts:
+                        path, counts["rows"] = future.result()
+                        copy_fts_from_database(conn, path, table_name)
+                    click.echo(
+                        "Populated full-text index for {}: {} rows".format(
+                            table_name, counts["rows"]
+                        )
+                    )
+        fts_tables = {}
+    else:
+        build_indexes()
 
-        generate_and_populate_fts(conn, created_tables.keys(), fts, foreign_keys)
+    for column, (distinct, slow) in date_stats.items():
+        click.echo(
+            "Parsed {} distinct date value{} in {}, {} needed dateparser".format(
+                distinct, "" if distinct == 1 else "s", column, slow
+            )
+        )
+
+    # Create FTS tables
+    for table_name in fts_tables:
+        indexing = ProgressReporter(
+            "Indexing {}".format(table_name),
+            (
+                conn.execute("select count(*) from [{}]".format(table_name)).fetchone()[
+                    0
+                ]
+                if progress
+                else None
+            ),
+            enabled=progress,
+        )
+        with import_stats.stage("generate_and_populate_fts", table_name) as counts:
+
+            def report_fts_progress(table, done, total):
+                indexing.update(done - (counts["rows"] or 0))
+                counts["rows"] = done
 
+            generate_and_populate_fts(
+                conn,
+                [table_name],
+                fts,
+                foreign_keys,
+                progress=report_fts_progress,
+            )
+        indexing.finish()
+        if not progress:
+            click.echo(
+                "Populated full-text index for {}: {} rows".format(
+                    table_name, counts["rows"] or 0
+                )
+            )
+
+    for name, record in file_records_to_save.items():
+        if name in failed_names:
+            continue
+        record["row_count"] = (record["row_count"] or 0) + row_counts.get(name, 0)
+        if (
+            record["header"] is None
+            and record["offset"] is not None
+            and name in encodings
+        ):
+            # Saved so that --append-only can parse rows added to the end
+            record["encoding"] = encodings[name]
+            record["header"] = json.dumps(
+                read_csv_header(csvs[name], separator, quoting, encodings[name])
+            )
+        save_file_record(conn, record)
+
+    conn.commit()
+    restore_pragmas(conn, previous_pragmas)
     conn.close()
 
+    for table_name, (inserted, updated, unchanged) in upsert_counts.items():
+        click.echo(
+            "Upserted into {}: {} inserted, {} updated, {} unchanged".format(
+                table_name, inserted, updated, unchanged
+            )
+        )
+
+    # Files that could not be loaded were not imported
+    imported = len(csvs) - len(failed_names)
     if db_existed:
         click.echo(
             "Added {} CSV file{} to {}".format(
-                len(csvs), "" if len(csvs) == 1 else "s", dbname
+                imported, "" if imported == 1 else "s", dbname
             )
         )
     else:
         click.echo(
             "Created {} from {} CSV file{}".format(
-                dbname, len(csvs), "" if len(csvs) == 1 else "s"
+                dbname, imported, "" if imported == 1 else "s"
             )
         )
+
+    if stats:
+        for line in import_stats.summary():
+            click.echo(line)
+    if stats_json:
+        with open(stats_json, "w") as fp:
+            json.dump(import_stats.to_dict(), fp, indent=2)
@@ -1,17 +1,47 @@
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
 import dateparser
 import os
+import posixpath
 import fnmatch
+import gzip
 import hashlib
-import lru
+import io
+import itertools
+import json
+import lzma
 import pandas as pd
 import numpy as np
 import re
 import six
 import sqlite3
+import sys
+import tempfile
+import time
+import warnings
+import zipfile
 
 from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlopen
 from six.moves.urllib.parse import uses_relative, uses_netloc, uses_params
 
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
 import click
 
 
@@ -19,47 +49,602 @@ class LoadCsvError(Exception):
     pass
 
 
+DEFAULT_ENCODINGS = ("utf8", "latin-1")
+
+
 def load_csv(
     filepath,
     separator,
     skip_errors,
     quoting,
     shape,
-    encodings_to_try=("utf8", "latin-1"),
+    encodings_to_try=DEFAULT_ENCODINGS,
     just_strings=False,
+    chunksize=None,
+    engine="c",
+    exclude_columns=(),
+    compact=False,
 ):
+    # If chunksize is set this returns an iterator of DataFrames instead
+    if compact:
+        loaded = load_csv(
+            filepath,
+            separator,
+            skip_errors,
+            quoting,
+            shape,
+            encodings_to_try=encodings_to_try,
+            just_strings=just_strings,
+            chunksize=chunksize,
+            engine=engine,
+            exclude_columns=exclude_columns,
+        )
+        if chunksize:
+            return (compact_dataframe(chunk) for chunk in loaded)
+        return compact_dataframe(loaded)
     dtype = str if just_strings is True else None
-    usecols = None
-    if shape:
-        usecols = [defn["csv_name"] for defn in parse_shape(shape)]
+    usecols = plan_columns(shape, exclude_columns)
+    kwargs = dict(
+        sep=separator,
+        quoting=quoting,
+        on_bad_lines="skip" if skip_errors else "error",
+        low_memory=True,
+        usecols=usecols,
+        dtype=dtype,
+    )
+    # Skip straight to the first encoding that can decode a sample of the file
+    detected = detect_encoding(filepath, encodings_to_try)
+    if detected is not None:
+        encodings_to_try = encodings_to_try[list(encodings_to_try).index(detected) :]
+    if isinstance(filepath, CsvTail):
+        if filepath.header is not None:
+            kwargs.update(header=None, names=filepath.header)
+        if filepath.encoding:
+            encodings_to_try = (filepath.encoding,)
+    if engine == "pyarrow":
+        return _load_csv_pyarrow(
+            filepath, encodings_to_try, separator, skip_errors, quoting, usecols, dtype
+        )
+    if chunksize:
+        return _load_csv_chunks(filepath, encodings_to_try, chunksize, kwargs)
     try:
         for encoding in encodings_to_try:
+            source = _open_csv(filepath)
             try:
-                return pd.read_csv(
-                    filepath,
-                    sep=separator,
-                    quoting=quoting,
-                    on_bad_lines="skip" if skip_errors else "error",
-                    low_memory=True,
-                    encoding=encoding,
-                    usecols=usecols,
-                    dtype=dtype,
-                )
+                df = pd.read_csv(source, encoding=encoding, **kwargs)
+                df.attrs["encoding"] = encoding
+                return df
             except UnicodeDecodeError:
                 continue
             except pd.errors.ParserError as e:
                 raise LoadCsvError(e)
+            finally:
+                if source is not filepath:
+                    source.close()
         # If we get here, we failed
         raise LoadCsvError("All encodings failed")
     except Exception as e:
         raise LoadCsvError(e)
 
 
+def _open_csv(filepath):
+    # Returns something pd.read_csv() can read from - if that is not filepath
+    # itself it is a file object which the caller must close
+    if isinstance(filepath, CsvTail):
+        return FileRange(filepath.path, filepath.offset, filepath.end)
+    if isinstance(filepath, ZipMember):
+        return CompressedFile(filepath.path, filepath.member)
+    if (
+        isinstance(filepath, six.string_types)
+        and os.path.isfile(filepath)
+        and not filepath.lower().endswith(PANDAS_COMPRESSION_SUFFIXES)
+    ):
+        # Opened here so that progress through the file can be reported
+        if is_compressed(filepath):
+            return CompressedFile(filepath)
+        return open(filepath, "rb")
+    return filepath
+
+
+# Compressed CSV files are decompressed as they are parsed
+COMPRESSION_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+CSV_FILE_PATTERNS = ("*.csv",) + tuple(
+    "*.csv" + suffix for suffix in COMPRESSION_SUFFIXES
+)
+
+# pandas extracts files with these suffixes if it is given their path
+PANDAS_COMPRESSION_SUFFIXES = (".zip", ".tar")
+
+
+def is_compressed(filepath):
+    return isinstance(filepath, six.string_types) and filepath.lower().endswith(
+        COMPRESSION_SUFFIXES
+    )
+
+
+def table_name_for_path(path):
+    "Returns path without its .csv extension, or its .csv.gz and so on"
+    root, ext = os.path.splitext(path)
+    if ext.lower() in COMPRESSION_SUFFIXES:
+        root = os.path.splitext(root)[0]
+    return root
+
+
+class CompressedFile(io.BufferedIOBase):
+    """A .gz, .bz2, .xz or .zst file or URL - or a member of a .zip archive,
+    if member is given - decompressed as it is read
+
+    tell() is the position in the compressed data rather than in the
+    decompressed data, so it can be compared with the compressed size.
+    """
+
+    def __init__(self, path, member=None):
+        if _is_url(path):
+            self.raw = _CountingReader(urlopen(path))
+            path = urlparse(path).path
+        else:
+            self.raw = open(path, "rb")
+        self.archive = None
+        self.start, self.size = 0, None
+        try:
+            if member is None:
+                self.decompressed = _decompress(path, self.raw)
+            else:
+                self.archive = zipfile.ZipFile(self.raw)
+                info = self.archive.getinfo(member)
+                self.decompressed = self.archive.open(info)
+                self.start, self.size = info.header_offset, info.compress_size
+        except Exception:
+            self.raw.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.decompressed.read(size)
+
+    def read1(self, size=-1):
+        read1 = getattr(self.decompressed, "read1", self.decompressed.read)
+        return read1(size if size >= 0 else io.DEFAULT_BUFFER_SIZE)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def tell(self):
+        position = self.raw.tell() - self.start
+        if self.size is None:
+            return position
+        # The archive's member header comes before the compressed data
+        return max(0, min(position, self.size))
+
+    def close(self):
+        if not self.closed:
+            self.decompressed.close()
+            if self.archive is not None:
+                self.archive.close()
+            self.raw.close()
+        super(CompressedFile, self).close()
+
+
+class FileRange(io.BufferedIOBase):
+    """The bytes of the file at path from start up to end, read as a file
+
+    tell() is the position in the whole file.
+    """
+
+    def __init__(self, path, start, end):
+        self.raw = open(path, "rb")
+        self.raw.seek(start)
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        remaining = max(0, self.end - self.raw.tell())
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.raw.read(size)
+
+    def read1(self, size=-1):
+        return self.read(size if size >= 0 else io.DEFAULT_BUFFER_SIZE)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super(FileRange, self).close()
+
+
+class _CountingReader(io.RawIOBase):
+    # A stream that cannot tell() its position, such as a HTTP response,
+    # with a tell() that counts the bytes read from it
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super(_CountingReader, self).close()
+
+
+def _decompress(path, raw):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".gz":
+        return gzip.GzipFile(fileobj=raw)
+    elif suffix == ".bz2":
+        return bz2.BZ2File(raw)
+    elif suffix == ".xz":
+        return lzma.LZMAFile(raw)
+    try:
+        # Python 3.14+
+        from compression import zstd
+
+        return zstd.ZstdFile(raw)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise LoadCsvError(
+            "zstandard is needed to read .zst files - try: pip install zstandard"
+        )
+    return zstandard.ZstdDecompressor().stream_reader(raw)
+
+
+def csv_size(filepath):
+    "Returns the number of bytes load_csv() will read from filepath, if known"
+    if isinstance(filepath, CsvTail):
+        return filepath.end - filepath.offset
+    if isinstance(filepath, ZipMember):
+        with zipfile.ZipFile(filepath.path) as archive:
+            return archive.getinfo(filepath.member).compress_size
+    if _is_local_file(filepath):
+        return os.path.getsize(filepath)
+    return None
+
+
+def _is_local_file(filepath):
+    return isinstance(filepath, six.string_types) and os.path.isfile(filepath)
+
+
+def _load_csv_chunks(filepath, encodings_to_try, chunksize, kwargs):
+    # The encoding is settled by the first chunk - once rows have been
+    # handed on we cannot go back and try a different one, so a later
+    # UnicodeDecodeError is raised as the __cause__ of a LoadCsvError and
+    # it is up to the caller to undo what it did with the earlier chunks
+    for encoding in encodings_to_try:
+        source = _open_csv(filepath)
+        reader = None
+        try:
+            reader = pd.read_csv(
+                source, encoding=encoding, chunksize=chunksize, **kwargs
+            )
+            first_chunk = next(reader)
+            break
+        except UnicodeDecodeError:
+            if reader is not None:
+                reader.close()
+            if source is not filepath:
+                source.close()
+            continue
+        except Exception as e:
+            if source is not filepath:
+                source.close()
+            raise LoadCsvError(e) from e
+    else:
+        raise LoadCsvError("All encodings failed")
+
+    def bytes_read():
+        # Only known if we opened the file ourselves
+        if source is filepath:
+            return None
+        return source.tell() - getattr(filepath, "offset", 0)
+
+    try:
+        with reader:
+            first_chunk.attrs["encoding"] = encoding
+            first_chunk.attrs["bytes_read"] = bytes_read()
+            yield first_chunk
+            try:
+                for chunk in reader:
+                    chunk.attrs["encoding"] = encoding
+                    chunk.attrs["bytes_read"] = bytes_read()
+                    yield chunk
+            except Exception as e:
+                raise LoadCsvError(e) from e
+    finally:
+        if source is not filepath:
+            source.close()
+
+
+ENGINES = ("c", "pyarrow")
+
+# The dtypes of columns read by the pyarrow engine - new in pandas 1.5
+ARROW_DTYPES = (pd.ArrowDtype,) if hasattr(pd, "ArrowDtype") else ()
+
+
+def pyarrow_available():
+    try:
+        import pyarrow.csv  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _load_csv_pyarrow(
+    filepath, encodings_to_try, separator, skip_errors, quoting, usecols, dtype
+):
+    # Reads the whole file with the multithreaded pyarrow CSV reader. The
+    # columns stay Arrow arrays (pd.ArrowDtype) all the way to the INSERTs.
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    parse_options = pa_csv.ParseOptions(
+        delimiter=separator,
+        quote_char=False if quoting == csv.QUOTE_NONE else '"',
+        invalid_row_handler=(lambda row: "skip") if skip_errors else None,
+    )
+    convert_options = pa_csv.ConvertOptions(strings_can_be_null=True)
+    for encoding in encodings_to_try:
+        read_options = pa_csv.ReadOptions(encoding=encoding)
+        if isinstance(filepath, CsvTail) and filepath.header is not None:
+            read_options.column_names = filepath.header
+        try:
+            schema = _pyarrow_schema(filepath, read_options, parse_options)
+            # pyarrow turns anything that looks like a date or a time into
+            # one, where pandas leaves the text for --date and --datetime to
+            # parse. So columns that look like dates in the first block of
+            # the file - or every column, for --just-strings - are strings.
+            convert_options.column_types = {
+                field.name: pa.string()
+                for field in schema
+                if dtype is str or pa.types.is_temporal(field.type)
+            }
+            if callable(usecols):
+                convert_options.include_columns = list(filter(usecols, schema.names))
+            elif usecols is not None:
+                convert_options.include_columns = usecols
+            source = _open_pyarrow_source(filepath)
+            try:
+                table = pa_csv.read_csv(
+                    source,
+                    read_options=read_options,
+                    parse_options=parse_options,
+                    convert_options=convert_options,
+                )
+            finally:
+                if source is not filepath:
+                    source.close()
+        except UnicodeDecodeError:
+            continue
+        except pa.ArrowInvalid as e:
+            if "invalid UTF8" in str(e):
+                continue
+            raise LoadCsvError(e)
+        except Exception as e:
+            raise LoadCsvError(e)
+        # Text that is not valid in this encoding is read as binary
+        if any(pa.types.is_binary(field.type) for field in table.schema):
+            continue
+        # Like pandas, keep the columns in the order they are in the file
+        table = table.select(
+            [name for name in schema.names if name in table.column_names]
+        )
+        # A column that was all nulls in the first block could still have
+        # been read as dates or times. One that is all nulls has no type -
+        # pandas reads those as floats, so they get the same column type.
+        for i, field in enumerate(table.schema):
+            if pa.types.is_temporal(field.type):
+                table = table.set_column(
+                    i, field.name, table.column(i).cast(pa.string())
+                )
+            elif pa.types.is_null(field.type):
+                table = table.set_column(
+                    i, field.name, table.column(i).cast(pa.float64())
+                )
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        df.attrs["encoding"] = encoding
+        return df
+    raise LoadCsvError("All encodings failed")
+
+
+def _pyarrow_schema(filepath, read_options, parse_options):
+    # The columns and types pyarrow infers from the first block of the file
+    import pyarrow.csv as pa_csv
+
+    source = _open_pyarrow_source(filepath)
+    try:
+        with pa_csv.open_csv(
+            source,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=pa_csv.ConvertOptions(strings_can_be_null=True),
+        ) as reader:
+            return reader.schema
+    finally:
+        if source is not filepath:
+            source.close()
+
+
+def _open_pyarrow_source(filepath):
+    # pyarrow reads local paths itself, but not URLs
+    if _is_url(filepath):
+        if is_compressed(urlparse(filepath).path):
+            return CompressedFile(filepath)
+        return urlopen(filepath)
+    if isinstance(filepath, (CsvTail, ZipMember)) or is_compressed(filepath):
+        return _open_csv(filepath)
+    return filepath
+
+
+def plan_columns(shape=None, exclude_columns=(), needed=None, added_columns=()):
+    """Works out which columns of each CSV need to be parsed
+
+    Returns the usecols= argument for pd.read_csv() - None for all of them,
+    a list of column names for --shape, or a function that is given each
+    column name for --exclude-column.
+
+    needed is {option: [column names]} for options that refer to columns
+    of the table, such as --fts - added_columns are the columns that will
+    be added to every table, such as --filename-column. If a needed column
+    would not be parsed this raises ValueError.
+    """
+    excluded = set(exclude_columns)
+    defns = parse_shape(shape) if shape else []
+    for defn in defns:
+        if defn["csv_name"] in excluded:
+            raise ValueError(
+                "{} is used by --shape but excluded by --exclude-column".format(
+                    defn["csv_name"]
+                )
+            )
+    for option, columns in (needed or {}).items():
+        for column in columns:
+            if column in added_columns:
+                continue
+            if defns and column not in [defn["db_name"] for defn in defns]:
+                raise ValueError(
+                    "{} is used by {} but is not in --shape".format(column, option)
+                )
+            if not defns and column in excluded:
+                raise ValueError(
+                    "{} is used by {} but excluded by --exclude-column".format(
+                        column, option
+                    )
+                )
+    if defns:
+        return [defn["csv_name"] for defn in defns]
+    if excluded:
+        return lambda column: column not in excluded
+    return None
+
+
+# With --compact, text columns with fewer distinct values than this share of
+# their rows are stored as categories
+COMPACT_CATEGORY_RATIO = 0.5
+
+
+def compact_dataframe(df, category_ratio=COMPACT_CATEGORY_RATIO):
+    """
+    Converts the columns of df, in place, to types that use less memory:
+
+    - integers are downcast to the smallest integer type that holds them
+    - floats are downcast to float32 if that loses nothing
+    - text that repeats - fewer than category_ratio of the values distinct -
+      becomes a category, so each distinct value is stored once
+    - other text becomes pyarrow backed strings, if pyarrow is installed
+
+    The values written to the database are unchanged. Returns df.
+    """
+    for column in df.columns:
+        series = df[column]
+        dtype = series.dtype
+        if isinstance(dtype, np.dtype) and dtype.kind in "iu":
+            df[column] = pd.to_numeric(
+                series, downcast="integer" if dtype.kind == "i" else "unsigned"
+            )
+        elif isinstance(dtype, np.dtype) and dtype.kind == "f":
+            values = series.to_numpy()
+            if dtype.itemsize > 4 and np.array_equal(
+                values.astype(np.float32), values, equal_nan=True
+            ):
+                df[column] = series.astype(np.float32)
+        elif pd.api.types.is_string_dtype(dtype) and not isinstance(
+            dtype, pd.CategoricalDtype
+        ):
+            # Columns holding anything but strings keep their type
+            if pd.api.types.infer_dtype(series, skipna=True) != "string":
+                continue
+            if series.nunique() < len(series) * category_ratio:
+                df[column] = series.astype("category")
+            elif getattr(dtype, "storage", None) != "pyarrow" and pyarrow_available():
+                df[column] = series.astype("string[pyarrow]")
+    return df
+
+
+def detect_encoding(filepath, encodings_to_try, sample_size=1024 * 1024):
+    """Returns the first of encodings_to_try that can decode a sample of filepath
+
+    The sample is taken from both the start and the end of the file, so that
+    a file which only goes wrong at the very end is not parsed twice. Returns
+    None if filepath is not a local file or no encoding could decode it.
+    """
+    tail = b""
+    if isinstance(filepath, ZipMember) or (
+        is_compressed(filepath) and os.path.isfile(filepath)
+    ):
+        # Reaching the end would mean decompressing the whole file
+        with _open_csv(filepath) as fp:
+            head = fp.read(sample_size)
+        complete = len(head) < sample_size
+    elif not isinstance(filepath, CsvTail) and not _is_local_file(filepath):
+        return None
+    else:
+        if isinstance(filepath, CsvTail):
+            path, start, end = filepath.path, filepath.offset, filepath.end
+        else:
+            path, start, end = filepath, 0, os.path.getsize(filepath)
+        with open(path, "rb") as fp:
+            fp.seek(start)
+            head = fp.read(min(sample_size, end - start))
+            if end - start > sample_size:
+                fp.seek(max(end - sample_size, start + sample_size))
+                tail = fp.read(end - fp.tell())
+        complete = not tail
+    for encoding in encodings_to_try:
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+            decoder.decode(head, final=complete)
+        except UnicodeDecodeError:
+            continue
+        if tail and not _can_decode_tail(tail, encoding):
+            continue
+        return encoding
+    return None
+
+
+def _can_decode_tail(tail, encoding):
+    # The tail may start part way through a multi-byte character
+    for skip in range(4):
+        try:
+            tail[skip:].decode(encoding)
+            return True
+        except UnicodeDecodeError:
+            continue
+    return False
+
+
 def csvs_from_paths(paths):
     csvs = {}
 
-    def add_item(filepath, full_path=None):
-        name = os.path.splitext(os.path.basename(filepath))[0]
+    def unique_name(name):
+        # Files that would share a name, such as data.csv and data.csv.gz,
+        # get a numeric suffix rather than overwriting each other
         if name in csvs:
             i = 1
             while True:
@@ -69,27 +654,378 @@ def csvs_from_paths(paths):
                     break
                 else:
                     i += 1
+        return name
+
+    def add_item(filepath, full_path=None):
+        name = unique_name(table_name_for_path(os.path.basename(filepath)))
         if full_path is None:
             csvs[name] = filepath
         else:
             csvs[name] = full_path
 
     for path in paths:
-        if os.path.isfile(path):
+        if os.path.isfile(path) and path.lower().endswith(".zip"):
+            # Like a directory, but the CSVs are read straight out of it
+            with zipfile.ZipFile(path) as archive:
+                members = archive.namelist()
+            for member in members:
+                dirname, filename = posixpath.split(member)
+                # Skip the resource forks of archives made by macOS
+                if member.startswith("__MACOSX/") or not fnmatch.fnmatch(
+                    filename, "*.csv"
+                ):
+                    continue
+                relpath = dirname.split("/") if dirname else ["."]
+                namepath = os.path.join(*relpath + [table_name_for_path(filename)])
+                csvs[unique_name(namepath)] = ZipMember(path, member)
+        elif os.path.isfile(path):
             add_item(path)
         elif _is_url(path):
             add_item(urlparse(path).path, path)
         elif os.path.isdir(path):
             # Recursively seek out ALL csvs in directory
             for root, dirnames, filenames in os.walk(path):
-                for filename in fnmatch.filter(filenames, "*.csv"):
+                for filename in filenames:
+                    if not any(
+                        fnmatch.fnmatch(filename, pattern)
+                        for pattern in CSV_FILE_PATTERNS
+                    ):
+                        continue
                     relpath = os.path.relpath(root, path)
-                    namepath = os.path.join(relpath, os.path.splitext(filename)[0])
-                    csvs[namepath] = os.path.join(root, filename)
+                    namepath = os.path.join(relpath, table_name_for_path(filename))
+                    csvs[unique_name(namepath)] = os.path.join(root, filename)
 
     return csvs
 
 
+# Used by --incremental to remember which files have been imported
+FILES_TABLE = "_csvs_to_sqlite_files"
+FILES_TABLE_COLUMNS = (
+    ("path", "TEXT PRIMARY KEY"),
+    ("name", "TEXT"),
+    ("table_name", "TEXT"),
+    ("size", "INTEGER"),
+    ("mtime", "REAL"),
+    ("sha256", "TEXT"),
+    ("row_count", "INTEGER"),
+    ("offset", "INTEGER"),
+    ("header", "TEXT"),
+    ("encoding", "TEXT"),
+    ("crc32", "INTEGER"),
+)
+
+
+class CsvTail(
+    collections.namedtuple("CsvTail", ("path", "offset", "header", "encoding", "end"))
+):
+    """The part of a CSV file from offset up to end, which has no header row
+    of its own - unless header is None, in which case offset is 0
+
+    Can be passed to load_csv() in place of a file path.
+    """
+
+    def __str__(self):
+        if not self.offset:
+            return self.path
+        return "{} (from byte {})".format(self.path, self.offset)
+
+
+class ZipMember(collections.namedtuple("ZipMember", ("path", "member"))):
+    """A CSV file inside a .zip archive, which is read without extracting it
+
+    Can be passed to load_csv() in place of a file path.
+    """
+
+    def __str__(self):
+        return "{}/{}".format(self.path, self.member)
+
+
+def ensure_files_table(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS [{}] ({})".format(
+            FILES_TABLE,
+            ", ".join(
+                '"{}" {}'.format(column, type) for column, type in FILES_TABLE_COLUMNS
+            ),
+        )
+    )
+    # Tables created by older versions may be missing some columns
+    existing = {
+        row[1] for row in conn.execute("PRAGMA table_info([{}])".format(FILES_TABLE))
+    }
+    for column, type in FILES_TABLE_COLUMNS:
+        if column not in existing:
+            conn.execute(
+                'ALTER TABLE [{}] ADD COLUMN "{}" {}'.format(FILES_TABLE, column, type)
+            )
+
+
+def file_records(conn):
+    # Returns {path: {column: value}} for every file previously imported
+    cursor = conn.execute("select * from [{}]".format(FILES_TABLE))
+    columns = [d[0] for d in cursor.description]
+    return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+
+def save_file_record(conn, record):
+    conn.execute(
+        "INSERT OR REPLACE INTO [{}] ({}) VALUES ({})".format(
+            FILES_TABLE,
+            ", ".join('"{}"'.format(key) for key in record),
+            ", ".join("?" for key in record),
+        ),
+        list(record.values()),
+    )
+
+
+def file_sha256(filepath, prefix_length=None, length=None):
+    """Returns the SHA-256 of filepath, in one pass over the file
+
+    If prefix_length is set returns (sha256 of file, sha256 of the first
+    prefix_length bytes) instead. If length is set only the first length
+    bytes of the file are hashed.
+    """
+    sha256 = hashlib.sha256()
+    prefix_sha256 = None
+    position = 0
+
+    def read_block():
+        if length is None:
+            return fp.read(1024 * 1024)
+        return fp.read(min(1024 * 1024, length - position))
+
+    with open(filepath, "rb") as fp:
+        for block in iter(read_block, b""):
+            if prefix_length is not None and position <= prefix_length:
+                if position + len(block) >= prefix_length:
+                    prefix = sha256.copy()
+                    prefix.update(block[: prefix_length - position])
+                    prefix_sha256 = prefix.hexdigest()
+            sha256.update(block)
+            position += len(block)
+    if prefix_length is None:
+        return sha256.hexdigest()
+    if prefix_length == 0:
+        prefix_sha256 = hashlib.sha256().hexdigest()
+    return sha256.hexdigest(), prefix_sha256
+
+
+def read_csv_header(filepath, separator, quoting, encoding):
+    source = _open_csv(filepath)
+    try:
+        return list(
+            pd.read_csv(
+                source, sep=separator, quoting=quoting, encoding=encoding, nrows=0
+            ).columns
+        )
+    finally:
+        if source is not filepath:
+            source.close()
+
+
+def plan_incremental_import(
+    conn, csvs, table=None, filename_column=None, append_only=False
+):
+    """Works out which of csvs have changed since they were last imported
+
+    Returns (csvs_to_import, records, tables_to_drop, partitions_to_delete):
+
+    - csvs_to_import is the subset of csvs that needs importing. With
+      append_only, files that have only grown have their path replaced by a
+      CsvTail so that just the new rows are read
+    - records is {name: record} with the size, mtime and sha256 of each file
+      in csvs_to_import, ready to be completed with a row_count and saved
+    - tables_to_drop lists tables that must be rebuilt from scratch, because
+      a file changed and its rows cannot be told apart from other files
+    - partitions_to_delete is {table: [names]} of filename_column values whose
+      rows should be deleted before the changed files are imported again
+
+    Members of .zip archives are checked against the size and CRC-32 stored
+    in the archive. Files that cannot be checked, such as URLs, are treated
+    as changed every time, so their rows are replaced rather than added to.
+    """
+    previous = file_records(conn)
+    records = {}
+    tails = {}
+    changed = set()
+    zip_infos = {}
+    for name, path in csvs.items():
+        if isinstance(path, ZipMember):
+            if path.path not in zip_infos:
+                with zipfile.ZipFile(path.path) as archive:
+                    zip_infos[path.path] = {
+                        info.filename: info for info in archive.infolist()
+                    }
+            info = zip_infos[path.path][path.member]
+            record = {
+                "path": _record_path(path),
+                "name": name,
+                "table_name": table or name,
+                "size": info.file_size,
+                "mtime": os.stat(path.path).st_mtime,
+                "sha256": None,
+                "row_count": None,
+                "offset": None,
+                "header": None,
+                "encoding": None,
+                "crc32": info.CRC,
+            }
+            old = previous.get(record["path"])
+            if old is not None and (old["size"], old["crc32"]) == (
+                record["size"],
+                record["crc32"],
+            ):
+                continue
+            if old is not None:
+                changed.add(name)
+            records[name] = record
+            continue
+        if not _can_check(path):
+            changed.add(name)
+            records[name] = {
+                "path": _record_path(path),
+                "name": name,
+                "table_name": table or name,
+                "size": None,
+                "mtime": None,
+                "sha256": None,
+                "row_count": None,
+                "offset": None,
+                "header": None,
+                "encoding": None,
+                "crc32": None,
+            }
+            continue
+        stat = os.stat(path)
+        # Rows written after this are left for the next import
+        offset = stat.st_size
+        if not is_compressed(path):
+            lines_end = _end_of_last_line(path, stat.st_size)
+            if append_only and lines_end:
+                # A last line without a newline may still be being written
+                offset = lines_end
+            elif lines_end != stat.st_size:
+                # Rows appended to it would run on from its last line
+                offset = None
+        record = {
+            "path": _record_path(path),
+            "name": name,
+            "table_name": table or name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": None,
+            "row_count": None,
+            "offset": offset,
+            "header": None,
+            "encoding": None,
+            "crc32": None,
+        }
+        old = previous.get(record["path"])
+        if old is not None and (old["size"], old["mtime"]) == (
+            record["size"],
+            record["mtime"],
+        ):
+            continue
+        if old is None:
+            record["sha256"] = file_sha256(path, length=record["size"])
+        else:
+            record["sha256"], prefix_sha256 = file_sha256(
+                path, old["size"], length=record["size"]
+            )
+            if old["sha256"] == record["sha256"]:
+                # Touched but not modified
+                save_file_record(conn, dict(old, mtime=record["mtime"]))
+                continue
+            if (
+                append_only
+                and not is_compressed(path)
+                and old["header"]
+                and old["offset"] is not None
+                and record["size"] > old["size"]
+                and prefix_sha256 == old["sha256"]
+                and table_exists(conn, record["table_name"])
+            ):
+                # Only new rows have been added - import just those
+                record.update(
+                    row_count=old["row_count"],
+                    header=old["header"],
+                    encoding=old["encoding"],
+                )
+                tails[name] = CsvTail(
+                    path,
+                    old["offset"],
+                    json.loads(old["header"]),
+                    old["encoding"],
+                    _import_end(record),
+                )
+            else:
+                changed.add(name)
+        records[name] = record
+
+    tables_to_drop = []
+    partitions_to_delete = {}
+    for name in changed:
+        record = records[name]
+        if not table_exists(conn, record["table_name"]):
+            continue
+        if filename_column:
+            partitions_to_delete.setdefault(record["table_name"], []).append(name)
+        elif record["table_name"] not in tables_to_drop:
+            tables_to_drop.append(record["table_name"])
+
+    csvs_to_import = {}
+    for name, path in csvs.items():
+        if name in tails and (table or name) not in tables_to_drop:
+            csvs_to_import[name] = tails[name]
+        elif name in records or (table or name) in tables_to_drop:
+            csvs_to_import[name] = path
+            if _can_check(path) and (name not in records or name in tails):
+                # Its table is being rebuilt, so it needs importing in full
+                old = previous[_record_path(path)]
+                records[name] = dict(records.get(name, old), name=name, row_count=None)
+            if _is_local_file(path) and not is_compressed(path):
+                # Read no further than the recorded size
+                csvs_to_import[name] = CsvTail(
+                    path, 0, None, None, _import_end(records[name])
+                )
+    return csvs_to_import, records, tables_to_drop, partitions_to_delete
+
+
+def _import_end(record):
+    # Where reading the file described by a files table record should stop
+    return record["size"] if record["offset"] is None else record["offset"]
+
+
+def _end_of_last_line(path, size):
+    # The position just after the last newline in the first size bytes of
+    # the file at path, or 0 if there is none
+    block_size = 64 * 1024
+    end = size
+    with open(path, "rb") as fp:
+        while end > 0:
+            start = max(0, end - block_size)
+            fp.seek(start)
+            newline = fp.read(end - start).rfind(b"\n")
+            if newline != -1:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def _can_check(path):
+    # Whether plan_incremental_import() can tell if path has changed
+    return isinstance(path, ZipMember) or _is_local_file(path)
+
+
+def _record_path(path):
+    # The key of path in the files table
+    if isinstance(path, ZipMember):
+        return str(ZipMember(os.path.abspath(path.path), path.member))
+    if not _is_local_file(path):
+        return path
+    return os.path.abspath(path)
+
+
 def _is_url(possible_url):
     valid_schemes = set(uses_relative + uses_netloc + uses_params)
     valid_schemes.discard("")
@@ -136,8 +1072,69 @@ class PathOrURL(click.Path):
             return super(PathOrURL, self).convert(value, param, ctx)
 
 
+# Roughly how many bytes each value => id entry in a LookupTable's cache
+# uses, on top of the characters of the value itself
+LOOKUP_ENTRY_OVERHEAD = 120
+DEFAULT_LOOKUP_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class LookupCache(dict):
+    """
+    The value => id cache used by LookupTable - a plain dict, so each entry
+    costs no more than the value string and the id it maps to.
+
+    Once the estimated memory use goes over max_memory, or there are more
+    than max_entries values, the oldest tenth of the entries are dropped.
+    Lookups using [] are counted in hits and misses.
+    """
+
+    def __init__(self, max_memory=None, max_entries=None):
+        super().__init__()
+        self.max_memory = max_memory
+        self.max_entries = max_entries
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fits(self, entries, memory):
+        "Would this many more entries, using this much memory, fit?"
+        return (
+            self.max_entries is None or len(self) + entries <= self.max_entries
+        ) and (self.max_memory is None or self.memory_used + memory <= self.max_memory)
+
+    def __getitem__(self, value):
+        try:
+            id = super().__getitem__(value)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return id
+
+    def __setitem__(self, value, id):
+        if value not in self:
+            self.memory_used += len(value) + LOOKUP_ENTRY_OVERHEAD
+        super().__setitem__(value, id)
+        if not self.fits(0, 0):
+            # dicts keep insertion order, so these are the oldest entries
+            oldest = list(itertools.islice(self, max(len(self) // 10, 1)))
+            for old in oldest:
+                self.memory_used -= len(old) + LOOKUP_ENTRY_OVERHEAD
+                del self[old]
+            self.evictions += len(oldest)
+
+
 class LookupTable:
-    def __init__(self, conn, table_name, value_column, index_fts):
+    def __init__(
+        self,
+        conn,
+        table_name,
+        value_column,
+        index_fts,
+        memory_budget=DEFAULT_LOOKUP_MEMORY_BUDGET,
+        max_entries=None,
+    ):
         self.conn = conn
         self.table_name = table_name
         self.value_column = value_column
@@ -145,7 +1142,10 @@ class LookupTable:
             table_name=table_name, value_column=value_column
         )
         self.index_fts = index_fts
-        self.cache = lru.LRUCacheDict(max_size=1000)
+        self.cache = LookupCache(max_memory=memory_budget, max_entries=max_entries)
+        # While complete is True every value in the table is in the cache, so
+        # a value missing from the cache can be inserted without a SELECT
+        self.complete = False
         self.ensure_table_exists()
 
     def ensure_table_exists(self):
@@ -163,10 +1163,9 @@ class LookupTable:
                     "id" INTEGER PRIMARY KEY,
                     "{value_column}" TEXT
                 );
-            """.format(
-                table_name=self.table_name, value_column=self.value_column
-            )
+            """.format(table_name=self.table_name, value_column=self.value_column)
             self.conn.execute(create_sql)
+            self.complete = True
             if self.index_fts:
                 # Add a FTS index on the value_column
                 self.conn.execute(
@@ -180,6 +1179,63 @@ class LookupTable:
                         value_column=self.value_column,
                     )
                 )
+        else:
+            self.preload()
+
+    def preload(self):
+        """
+        Loads the value => id mapping of the existing table into the cache in
+        one query, if it fits. If it does not, makes sure the value column is
+        indexed so values can be looked up quickly.
+        """
+        count, length = self.conn.execute(
+            'SELECT count(*), coalesce(sum(length("{value_column}")), 0) FROM "{table_name}"'.format(
+                table_name=self.table_name, value_column=self.value_column
+            )
+        ).fetchone()
+        if not self.cache.fits(count, count * LOOKUP_ENTRY_OVERHEAD + length):
+            self.ensure_value_index()
+            return
+        # In descending order, so the lowest id for a value wins
+        for value, id in self.conn.execute(
+            'SELECT "{value_column}", id FROM "{table_name}" ORDER BY id DESC'.format(
+                table_name=self.table_name, value_column=self.value_column
+            )
+        ):
+            if value is not None:
+                self.cache[self.value_as_string(value)] = id
+        self.complete = True
+
+    def ensure_value_index(self):
+        if [self.value_column] in existing_indexes(self.conn, self.table_name):
+            return
+        sql = 'CREATE {unique}INDEX "{table_name}_{value_column}" ON "{table_name}" ("{value_column}")'
+        try:
+            # Values are only ever inserted once, so they can be UNIQUE
+            self.conn.execute(
+                sql.format(
+                    unique="UNIQUE ",
+                    table_name=self.table_name,
+                    value_column=self.value_column,
+                )
+            )
+        except sqlite3.IntegrityError:
+            # A table that was not created by csvs-to-sqlite may repeat values
+            self.conn.execute(
+                sql.format(
+                    unique="",
+                    table_name=self.table_name,
+                    value_column=self.value_column,
+                )
+            )
+
+    def remember(self, value, id):
+        self.cache[value] = id
+        if self.complete and self.cache.evictions:
+            # Too many values to keep them all, so from now on values that
+            # are not in the cache have to be looked up in the table
+            self.complete = False
+            self.ensure_value_index()
 
     def __repr__(self):
         return "<{}: {} rows>".format(
@@ -192,21 +1248,18 @@ class LookupTable:
     def id_for_value(self, value):
         if pd.isnull(value):
             return None
-        # value should be a string
-        if not isinstance(value, six.string_types):
-            if isinstance(value, float):
-                value = "{0:g}".format(value)
-            else:
-                value = six.text_type(value)
+        value = self.value_as_string(value)
         try:
             # First try our in-memory cache
             return self.cache[value]
         except KeyError:
-            # Next try the database table
-            sql = 'SELECT id FROM "{table_name}" WHERE "{value_column}"=?'.format(
-                table_name=self.table_name, value_column=self.value_column
-            )
-            result = self.conn.execute(sql, (value,)).fetchall()
+            result = None
+            if not self.complete:
+                # Next try the database table
+                sql = 'SELECT id FROM "{table_name}" WHERE "{value_column}"=?'.format(
+                    table_name=self.table_name, value_column=self.value_column
+                )
+                result = self.conn.execute(sql, (value,)).fetchall()
             if result:
                 id = result[0][0]
             else:
@@ -215,9 +1268,7 @@ class LookupTable:
                 cursor.execute(
                     """
                     INSERT INTO "{table_name}" ("{value_column}") VALUES (?);
-                """.format(
-                        table_name=self.table_name, value_column=self.value_column
-                    ),
+                """.format(table_name=self.table_name, value_column=self.value_column),
                     (value,),
                 )
                 id = cursor.lastrowid
@@ -231,12 +1282,126 @@ class LookupTable:
                     )
                     cursor.execute(sql, (id, value))
 
-            self.cache[value] = id
-            return id
+            self.remember(value, id)
+            return id
+
+    @staticmethod
+    def value_as_string(value):
+        # value should be a string
+        if not isinstance(value, six.string_types):
+            if isinstance(value, float):
+                value = "{0:g}".format(value)
+            else:
+                value = six.text_type(value)
+        return value
+
+    def ids_for_values(self, series):
+        """Bulk equivalent of series.apply(self.id_for_value)
+
+        Each distinct value is converted to a string once, then any values
+        not already in the cache are resolved against the lookup table in a
+        single query - unless the cache holds the whole table. Values that
+        are still missing are inserted in order of first appearance, so they
+        get the same ids as id_for_value() would have given them.
+        """
+        categorical = isinstance(series.dtype, pd.CategoricalDtype)
+        if categorical:
+            # Only the categories need resolving - in order of first use
+            codes = series.cat.codes.to_numpy()
+            raws = series.cat.categories[pd.unique(codes[codes >= 0])]
+        else:
+            raws = pd.unique(series.dropna())
+        value_for_raw = {raw: self.value_as_string(raw) for raw in raws}
+        if not value_for_raw:
+            # All nulls - match the object dtype apply() would have produced
+            return pd.Series(None, index=series.index, dtype=object, name=series.name)
+        ids = {}
+        missing = []
+        for value in dict.fromkeys(value_for_raw.values()):
+            try:
+                ids[value] = self.cache[value]
+            except KeyError:
+                missing.append(value)
+        if missing:
+            found = {} if self.complete else self._ids_for_values(missing)
+            to_insert = [value for value in missing if value not in found]
+            if to_insert:
+                found.update(self._insert_values(to_insert))
+            for value in missing:
+                ids[value] = found[value]
+                self.remember(value, found[value])
+        id_for_raw = {raw: ids[value] for raw, value in value_for_raw.items()}
+        if categorical:
+            # The same values map() would have produced: float if any are null
+            ids_by_code = np.array(
+                [id_for_raw.get(raw, np.nan) for raw in series.cat.categories]
+                + [np.nan]
+            )
+            ids_for_rows = ids_by_code[codes]
+            if (codes >= 0).all():
+                ids_for_rows = ids_for_rows.astype(np.int64)
+            return pd.Series(ids_for_rows, index=series.index, name=series.name)
+        return series.map(id_for_raw)
+
+    def _ids_for_values(self, values):
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS _csvs_to_sqlite_values (value TEXT)"
+        )
+        self.conn.execute("DELETE FROM temp._csvs_to_sqlite_values")
+        self.conn.executemany(
+            "INSERT INTO temp._csvs_to_sqlite_values (value) VALUES (?)",
+            ((value,) for value in values),
+        )
+        return self._ids_for_temp_values()
+
+    def _insert_values(self, values):
+        # Returns {value: id} - the ids are given explicitly, so they do not
+        # have to be looked up again afterwards
+        max_id = self.conn.execute(
+            'SELECT max(id) FROM "{}"'.format(self.table_name)
+        ).fetchone()[0]
+        ids = {value: (max_id or 0) + i for i, value in enumerate(values, 1)}
+        self.conn.executemany(
+            'INSERT INTO "{table_name}" (id, "{value_column}") VALUES (?, ?)'.format(
+                table_name=self.table_name, value_column=self.value_column
+            ),
+            ((id, value) for value, id in ids.items()),
+        )
+        if self.index_fts:
+            self.conn.executemany(
+                'INSERT INTO "{fts_table_name}" (rowid, "{value_column}") VALUES (?, ?)'.format(
+                    fts_table_name=self.fts_table_name,
+                    value_column=self.value_column,
+                ),
+                ((id, value) for value, id in ids.items()),
+            )
+        return ids
+
+    def _ids_for_temp_values(self):
+        sql = """
+            SELECT v.value, min(t.id)
+            FROM temp._csvs_to_sqlite_values v
+            JOIN "{table_name}" t ON t."{value_column}" = v.value
+            GROUP BY v.value
+        """.format(table_name=self.table_name, value_column=self.value_column)
+        return dict(self.conn.execute(sql).fetchall())
 
 
-def refactor_dataframes(conn, dataframes, foreign_keys, index_fts):
-    lookup_tables = {}
+def refactor_dataframes(
+    conn,
+    dataframes,
+    foreign_keys,
+    index_fts,
+    lookup_tables=None,
+    progress=None,
+    memory_budget=DEFAULT_LOOKUP_MEMORY_BUDGET,
+    max_entries=None,
+):
+    # Pass the same lookup_tables dictionary to reuse them across calls. If
+    # provided, progress(n) is called after the n values of each column are
+    # resolved
+    if lookup_tables is None:
+        lookup_tables = {}
     for column, (table_name, value_column) in foreign_keys.items():
         # Now apply this to the dataframes
         for dataframe in dataframes:
@@ -248,12 +1413,387 @@ def refactor_dataframes(conn, dataframes, foreign_keys, index_fts):
                         table_name=table_name,
                         value_column=value_column,
                         index_fts=index_fts,
+                        memory_budget=memory_budget,
+                        max_entries=max_entries,
                     )
                     lookup_tables[table_name] = lookup_table
-                dataframe[column] = dataframe[column].apply(lookup_table.id_for_value)
+                dataframe[column] = lookup_table.ids_for_values(dataframe[column])
+                if progress is not None:
+                    progress(len(dataframe))
     return dataframes
 
 
+# Used by --fast: trade durability for speed while the database is built
+FAST_PRAGMAS = (
+    ("journal_mode", "MEMORY"),
+    ("synchronous", "OFF"),
+    ("cache_size", "-262144"),
+    ("temp_store", "MEMORY"),
+    ("locking_mode", "EXCLUSIVE"),
+)
+
+pragma_re = re.compile(r"^\s*(\w+)\s*=\s*(.+?)\s*$")
+
+
+def parse_pragma(pragma):
+    # 'cache_size=-1000' => ('cache_size', '-1000')
+    m = pragma_re.match(pragma)
+    if not m:
+        raise ValueError("PRAGMA must be in the format name=value")
+    return m.group(1), m.group(2)
+
+
+def apply_pragmas(conn, pragmas):
+    # Returns the previous values, ready to pass to restore_pragmas()
+    previous = []
+    for name, value in pragmas:
+        row = conn.execute("PRAGMA {}".format(name)).fetchone()
+        if row is not None:
+            previous.append((name, row[0]))
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    return previous
+
+
+def restore_pragmas(conn, previous):
+    # Settings like journal_mode cannot change inside a transaction
+    conn.commit()
+    for name, value in reversed(previous):
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    # Leaving EXCLUSIVE locking mode only releases the lock on next access
+    conn.execute("select count(*) from sqlite_master").fetchall()
+
+
+def prepare_dataframe(
+    df,
+    name,
+    filename_column=None,
+    fixed_columns=(),
+    shape=None,
+    date_cols=(),
+    datetime_cols=(),
+    datetime_formats=(),
+):
+    # Applies the per-file transformations, in place, before extraction
+    if filename_column:
+        df[filename_column] = name
+    for colname, value in fixed_columns:
+        df[colname] = value
+    apply_shape(df, shape)
+    # Stored in attrs so it survives being sent back from a worker process
+    df.attrs["date_stats"] = apply_dates_and_datetimes(
+        df, date_cols, datetime_cols, datetime_formats
+    )
+    return df
+
+
+def load_and_prepare_csv(filepath, name, load_kwargs, prepare_kwargs):
+    # Module level function so it can be run in a worker process. The time
+    # taken by each step is stored in attrs so it can be reported by --stats
+    start = time.perf_counter()
+    df = load_csv(filepath, **load_kwargs)
+    loaded = time.perf_counter()
+    df = prepare_dataframe(df, name, **prepare_kwargs)
+    df.attrs["timings"] = {
+        "load_csv": loaded - start,
+        "apply_dates_and_datetimes": time.perf_counter() - loaded,
+    }
+    return df
+
+
+def load_and_prepare_csvs_in_parallel(csvs, jobs, load_kwargs, prepare_kwargs):
+    """Runs load_and_prepare_csv() for each of csvs in a process pool
+
+    Yields (name, path, df, error) tuples in the same order as csvs, where
+    error is the LoadCsvError if that file could not be loaded. At most
+    2 * jobs files are parsed ahead of the one being consumed.
+    """
+    items = iter(csvs.items())
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+
+        def submit_next():
+            item = next(items, None)
+            if item is not None:
+                name, path = item
+                future = executor.submit(
+                    load_and_prepare_csv, path, name, load_kwargs, prepare_kwargs
+                )
+                pending.append((name, path, future))
+
+        for _ in range(2 * jobs):
+            submit_next()
+        while pending:
+            name, path, future = pending.popleft()
+            submit_next()
+            try:
+                yield name, path, future.result(), None
+            except LoadCsvError as e:
+                yield name, path, None, e
+
+
+def peak_rss():
+    "Returns the peak resident set size of this process in bytes, if known"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ImportStats:
+    """
+    Records the wall time and rows processed of each stage of an import, for
+    each file or table that stage was run against, along with the process's
+    peak memory use so far when the stage finished. That is not the memory
+    used by the stage itself: once one stage has used a lot of memory, every
+    later stage shows the same peak.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # (stage, name) => {"seconds": ..., "rows": ..., "peak_rss_so_far": ...}
+        self.records = collections.OrderedDict()
+        # lookup table name => {"hits": ..., "misses": ..., "entries": ...}
+        self.lookup_caches = collections.OrderedDict()
+
+    def add_lookup_cache(self, table_name, cache):
+        self.lookup_caches[table_name] = {
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "entries": len(cache),
+            "evictions": cache.evictions,
+        }
+
+    def add(self, stage, name, seconds, rows=None):
+        record = self.records.setdefault(
+            (stage, name), {"seconds": 0.0, "rows": None, "peak_rss_so_far": None}
+        )
+        # Chunked imports run each stage many times for the same file
+        record["seconds"] += seconds
+        if rows is not None:
+            record["rows"] = (record["rows"] or 0) + rows
+        record["peak_rss_so_far"] = peak_rss()
+        return record
+
+    @contextlib.contextmanager
+    def stage(self, stage, name=None):
+        """
+        Times the body of the with block. Set counts["rows"] inside it to
+        record how many rows were processed:
+
+            with stats.stage("load_csv", name) as counts:
+                df = load_csv(path, ...)
+                counts["rows"] = len(df)
+        """
+        counts = {"rows": None}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(stage, name, time.perf_counter() - start, counts["rows"])
+
+    def stage_totals(self):
+        totals = collections.OrderedDict()
+        for (stage, name), record in self.records.items():
+            total = totals.setdefault(
+                stage, {"seconds": 0.0, "rows": None, "peak_rss_so_far": None}
+            )
+            total["seconds"] += record["seconds"]
+            if record["rows"] is not None:
+                total["rows"] = (total["rows"] or 0) + record["rows"]
+            total["peak_rss_so_far"] = record["peak_rss_so_far"]
+        return totals
+
+    def to_dict(self):
+        def with_rate(stage, name, record):
+            return dict(
+                stage=stage,
+                name=name,
+                rows_per_second=_rows_per_second(record),
+                **record
+            )
+
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "peak_rss": peak_rss(),
+            "stages": [
+                with_rate(stage, None, record)
+                for stage, record in self.stage_totals().items()
+            ],
+            "files": [
+                with_rate(stage, name, record)
+                for (stage, name), record in self.records.items()
+                if name is not None
+            ],
+            "lookup_caches": self.lookup_caches,
+            "sqlite": sqlite_capabilities()._asdict(),
+        }
+
+    def summary(self):
+        "Returns the stats as lines of a table, with a total for each stage"
+        lines = [
+            "{:<26} {:<24} {:>10} {:>10} {:>10} {:>14}".format(
+                "Stage", "File / table", "Seconds", "Rows", "Rows/sec", "Peak MB so far"
+            )
+        ]
+        totals = self.stage_totals()
+        for stage, total in totals.items():
+            names = [n for (s, n) in self.records if s == stage and n is not None]
+            rows = [(name, self.records[(stage, name)]) for name in names]
+            if len(rows) != 1 or (stage, None) in self.records:
+                rows.append(("(total)", total))
+            for name, record in rows:
+                rate = _rows_per_second(record)
+                lines.append(
+                    "{:<26} {:<24} {:>10.3f} {:>10} {:>10} {:>14}".format(
+                        stage,
+                        str(name),
+                        record["seconds"],
+                        "-" if record["rows"] is None else record["rows"],
+                        "-" if rate is None else int(rate),
+                        (
+                            "-"
+                            if record["peak_rss_so_far"] is None
+                            else "{:.1f}".format(
+                                record["peak_rss_so_far"] / 1024 / 1024
+                            )
+                        ),
+                    )
+                )
+        for table_name, cache in self.lookup_caches.items():
+            lookups = cache["hits"] + cache["misses"]
+            lines.append(
+                "Lookup table {}: {} hits, {} misses{}, {} values cached".format(
+                    table_name,
+                    cache["hits"],
+                    cache["misses"],
+                    (
+                        " ({:.1%} hit rate)".format(cache["hits"] / lookups)
+                        if lookups
+                        else ""
+                    ),
+                    cache["entries"],
+                )
+            )
+        lines.append("Total: {:.3f} seconds".format(time.perf_counter() - self.start))
+        return lines
+
+
+def _rows_per_second(record):
+    if record["rows"] is None or not record["seconds"]:
+        return None
+    return record["rows"] / record["seconds"]
+
+
+class ProgressReporter:
+    """
+    Shows progress towards length - which is None if it is not known - as a
+    click progress bar with the throughput and ETA. If the output is not a
+    terminal a log line is written every interval seconds instead.
+
+    update(n) moves the bar on by n units, count(name, n) adds n to a running
+    total shown alongside it, such as the number of rows inserted so far.
+    Does nothing at all if enabled is False.
+    """
+
+    def __init__(
+        self, label, length=None, unit="rows", enabled=True, interval=10.0, file=None
+    ):
+        self.label = label
+        self.length = length
+        self.unit = unit
+        self.enabled = enabled and length != 0
+        self.interval = interval
+        self.file = file or click.get_text_stream("stdout")
+        self.pos = 0
+        self.counts = collections.OrderedDict()
+        self.start = self.last_logged = time.time()
+        self.bar = None
+        self.finished = False
+        if self.enabled and self.file.isatty():
+            self.bar = click.progressbar(
+                # An endless iterable makes the length unknown to click
+                itertools.count() if length is None else None,
+                length=length,
+                label=label,
+                show_pos=unit != "bytes",
+                item_show_func=lambda item: item,
+                file=self.file,
+            )
+            self.bar.__enter__()
+
+    def update(self, n):
+        if not self.enabled:
+            return
+        self.pos += n
+        self._report(n)
+
+    def count(self, name, n):
+        if not self.enabled:
+            return
+        self.counts[name] = self.counts.get(name, 0) + n
+        self._report(0)
+
+    def finish(self):
+        if not self.enabled or self.finished:
+            return
+        self.finished = True
+        if self.bar is not None:
+            self.bar.current_item = self.details()
+            self.bar.render_progress()
+            self.bar.__exit__(None, None, None)
+        else:
+            click.echo(self.log_line(), file=self.file)
+
+    def _report(self, n):
+        if self.bar is not None:
+            # Set directly, as click 7 does not accept current_item in update()
+            self.bar.current_item = self.details()
+            self.bar.update(n)
+        elif time.time() - self.last_logged >= self.interval:
+            self.last_logged = time.time()
+            click.echo(self.log_line(), file=self.file)
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.pos / elapsed if elapsed else None
+
+    def details(self):
+        bits = []
+        rate = self.rate()
+        if rate is not None:
+            bits.append("{}/sec".format(self._amount(rate)))
+        for name, n in self.counts.items():
+            bits.append("{:,} {}".format(n, name))
+        return ", ".join(bits)
+
+    def log_line(self):
+        if self.length:
+            line = "{}: {} of {} ({:.0%})".format(
+                self.label,
+                self._amount(self.pos, unit=False),
+                self._amount(self.length),
+                min(self.pos / self.length, 1),
+            )
+        else:
+            line = "{}: {}".format(self.label, self._amount(self.pos))
+        details = self.details()
+        if details:
+            line += ", " + details
+        rate = self.rate()
+        if self.length and rate and not self.finished:
+            remaining = max(self.length - self.pos, 0) / rate
+            line += ", ETA {}".format(datetime.timedelta(seconds=int(remaining)))
+        return line
+
+    def _amount(self, n, unit=True):
+        if self.unit == "bytes":
+            amount, unit_name = "{:,.1f}".format(n / 1024 / 1024), "MB"
+        else:
+            amount, unit_name = "{:,}".format(int(n)), self.unit
+        return "{} {}".format(amount, unit_name) if unit else amount
+
+
 def table_exists(conn, table):
     return conn.execute(
         """
@@ -266,49 +1806,94 @@ def table_exists(conn, table):
 
 def drop_table(conn, table):
     conn.execute("DROP TABLE [{}]".format(table))
+    # And the full-text index created by --fts, if there is one
+    if table_exists(conn, "{}_fts".format(table)):
+        conn.execute("DROP TABLE [{}_fts]".format(table))
+
+
+def delete_rows(conn, table, column, values):
+    # In batches, so as not to go over the limit on ? parameters
+    values = list(values)
+    batch_size = sqlite_capabilities().max_variables
+    for start in range(0, len(values), batch_size):
+        batch = values[start : start + batch_size]
+        conn.execute(
+            "DELETE FROM [{}] WHERE [{}] IN ({})".format(
+                table, column, ", ".join("?" for value in batch)
+            ),
+            batch,
+        )
+
+
+# Same as pandas uses for SQLite tables without SQLAlchemy
+PANDAS_SQLITE_TYPES = {
+    "string": "TEXT",
+    "floating": "REAL",
+    "integer": "INTEGER",
+    "datetime": "TIMESTAMP",
+    "date": "DATE",
+    "time": "TIME",
+    "boolean": "INTEGER",
+}
 
 
 def get_create_table_sql(
-    table_name, df, index=True, sql_type_overrides=None, primary_keys=None
+    table_name,
+    df,
+    index=True,
+    sql_type_overrides=None,
+    primary_keys=None,
+    type_sample_size=None,
 ):
-    # Create a temporary table with just the first row
-    # We do this in memory because we just want to get the
-    # CREATE TABLE statement
-    # Returns (sql, columns)
-    conn = sqlite3.connect(":memory:")
-    # Before calling to_sql we need correct the dtypes that we will be using
-    # to pick the right SQL column types. pandas mostly gets this right...
-    # except for columns that contain a mixture of integers and Nones. These
-    # will be incorrectly detected as being of DB type REAL when we want them
-    # to be INTEGER instead.
+    # Builds the CREATE TABLE statement pandas.to_sql() would use, without
+    # creating a table. Returns (sql, columns)
+    # pandas mostly gets the column types right... except for columns that
+    # contain a mixture of integers and Nones. These will be incorrectly
+    # detected as being of DB type REAL when we want them to be INTEGER.
     # http://pandas.pydata.org/pandas-docs/stable/gotchas.html#support-for-integer-na
-    sql_type_overrides = sql_type_overrides or {}
-    if isinstance(df, pd.DataFrame):
-        columns_and_types = df.dtypes.items()
-    elif isinstance(df, pd.Series):
-        columns_and_types = [(df.name, df.dtype)]
-    for column, dtype in columns_and_types:
+    # If type_sample_size is set only that many rows are checked for this.
+    sql_type_overrides = dict(sql_type_overrides or {})
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    sample = df if type_sample_size is None else df[:type_sample_size]
+    for column, dtype in df.dtypes.items():
         # Are any of these float columns?
-        if dtype in (np.float32, np.float64):
+        if pd.api.types.is_float_dtype(dtype) and column not in sql_type_overrides:
             # if every non-NaN value is an integer, switch to int
-            if isinstance(df, pd.Series):
-                series = df
-            else:
-                series = df[column]
-            num_non_integer_floats = series.map(
-                lambda v: not np.isnan(v) and not v.is_integer()
-            ).sum()
-            if num_non_integer_floats == 0:
+            values = sample[column].to_numpy(dtype=np.float64, na_value=np.nan)
+            integer_or_nan = np.isnan(values) | (
+                np.isfinite(values) & (np.trunc(values) == values)
+            )
+            if integer_or_nan.all():
                 # Everything was NaN or an integer-float - switch type:
                 sql_type_overrides[column] = "INTEGER"
 
-    df[:1].to_sql(table_name, conn, index=index, dtype=sql_type_overrides)
-    sql = conn.execute(
-        "select sql from sqlite_master where name = ?", [table_name]
-    ).fetchone()[0]
-    columns = [
-        row[1] for row in conn.execute("PRAGMA table_info([{}])".format(table_name))
-    ]
+    # Like pandas, all other types are inferred from the first row
+    first_row = df[:1]
+    columns_and_types = []
+    if index:
+        if df.index.name is None and "index" not in df.columns:
+            index_label = "index"
+        else:
+            index_label = df.index.name if df.index.name is not None else "level_0"
+        columns_and_types.append(
+            (str(index_label), _sqlite_type_name(first_row.index.to_series()))
+        )
+    for column in df.columns:
+        if column in sql_type_overrides:
+            sql_type = sql_type_overrides[column]
+        else:
+            sql_type = _sqlite_type_name(first_row[column])
+        columns_and_types.append((str(column), sql_type))
+
+    sql = 'CREATE TABLE "{}" (\n{}\n)'.format(
+        table_name.replace('"', '""'),
+        ",\n  ".join(
+            '"{}" {}'.format(column.replace('"', '""'), sql_type)
+            for column, sql_type in columns_and_types
+        ),
+    )
+    columns = [column for column, _ in columns_and_types]
     if primary_keys:
         # Rewrite SQL to add PRIMARY KEY (col1, col2) at end
         assert sql[-1] == ")"
@@ -318,6 +1903,20 @@ def get_create_table_sql(
     return sql, columns
 
 
+def _sqlite_type_name(series):
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred == "timedelta64":
+        inferred = "integer"
+    elif inferred == "datetime64":
+        inferred = "datetime"
+    elif inferred == "complex":
+        raise ValueError("Complex datatypes not supported")
+    return PANDAS_SQLITE_TYPES.get(inferred, "TEXT")
+
+
+DEFAULT_BATCH_SIZE = 10000
+
+
 def to_sql_with_foreign_keys(
     conn,
     df,
@@ -326,6 +1925,33 @@ def to_sql_with_foreign_keys(
     sql_type_overrides=None,
     primary_keys=None,
     index_fks=False,
+    type_sample_size=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    progress=None,
+):
+    create_table_with_foreign_keys(
+        conn,
+        df,
+        name,
+        foreign_keys,
+        sql_type_overrides,
+        primary_keys=primary_keys,
+        index_fks=index_fks,
+        type_sample_size=type_sample_size,
+    )
+    # Now that we have created the table, insert the rows:
+    insert_dataframe(conn, df, df.table_name, batch_size=batch_size, progress=progress)
+
+
+def create_table_with_foreign_keys(
+    conn,
+    df,
+    name,
+    foreign_keys,
+    sql_type_overrides=None,
+    primary_keys=None,
+    index_fks=False,
+    type_sample_size=None,
 ):
     create_sql, columns = get_create_table_sql(
         name,
@@ -333,6 +1959,7 @@ def to_sql_with_foreign_keys(
         index=False,
         primary_keys=primary_keys,
         sql_type_overrides=sql_type_overrides,
+        type_sample_size=type_sample_size,
     )
     foreign_key_bits = []
     index_bits = []
@@ -352,31 +1979,270 @@ def to_sql_with_foreign_keys(
     foreign_key_sql = ",\n    ".join(foreign_key_bits)
     if foreign_key_sql:
         create_sql = "{},\n{});".format(create_sql.strip().rstrip(")"), foreign_key_sql)
-    if index_bits:
-        create_sql += "\n" + "\n".join(index_bits)
-    conn.executescript(create_sql)
-    # Now that we have created the table, insert the rows:
-    df.to_sql(df.table_name, conn, if_exists="append", index=False)
+    # Separate execute() calls rather than executescript(), which would
+    # commit the import's open transaction
+    conn.execute(create_sql)
+    for index_sql in index_bits:
+        conn.execute(index_sql)
+
+
+def insert_dataframe(
+    conn, df, table_name, batch_size=DEFAULT_BATCH_SIZE, progress=None
+):
+    """
+    Inserts the rows of df into an existing table, batch_size rows at a time,
+    using a single prepared INSERT and executemany(). Values are converted the
+    same way pandas.to_sql() converts them, but a column at a time rather than
+    a row at a time and without committing. If provided, progress(n) is called
+    after each batch of n rows.
+    """
+    if not len(df.columns):
+        return
+    _execute_in_batches(conn, _insert_sql(df, table_name), df, batch_size, progress)
+
+
+def upsert_dataframe(
+    conn, df, table_name, primary_keys, batch_size=DEFAULT_BATCH_SIZE, progress=None
+):
+    """
+    Like insert_dataframe(), but rows whose primary_keys match an existing
+    row update that row instead, using INSERT ... ON CONFLICT DO UPDATE. Rows
+    that would not change anything are left alone. The table must have a
+    PRIMARY KEY or UNIQUE constraint on primary_keys.
+
+    Returns (rows inserted, rows updated, rows unchanged).
+    """
+    columns = [_quote(column) for column in df.columns]
+    keys = [_quote(column) for column in primary_keys]
+    others = [column for column in columns if column not in keys]
+    table = _quote(table_name)
+    if others:
+        action = "UPDATE SET {} WHERE {}".format(
+            ", ".join("{0} = excluded.{0}".format(column) for column in others),
+            " OR ".join(
+                "{0}.{1} IS NOT excluded.{1}".format(table, column) for column in others
+            ),
+        )
+    else:
+        action = "NOTHING"
+    sql = "{} ON CONFLICT ({}) DO {}".format(
+        _insert_sql(df, table_name), ", ".join(keys), action
+    )
+    # A row is inserted if its key is not in the table yet. Each batch's keys
+    # go in a temporary table - with the same column types, so they compare
+    # the same way - and are looked up using the index on primary_keys,
+    # rather than counting every row in the table before and after.
+    keys_table = "_csvs_to_sqlite_upsert_keys"
+    conn.execute("DROP TABLE IF EXISTS temp.{}".format(keys_table))
+    conn.execute(
+        "CREATE TEMP TABLE {} AS SELECT {} FROM {} WHERE 0".format(
+            keys_table, ", ".join(keys), table
+        )
+    )
+    # Keys with a NULL in them never conflict
+    count_sql = """
+        SELECT (
+            SELECT count(*) FROM {keys_table} WHERE {any_null}
+        ) + (
+            SELECT count(*) FROM (
+                SELECT DISTINCT {keys} FROM {keys_table} WHERE NOT ({any_null})
+            ) AS batch
+            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {matches})
+        )
+    """.format(
+        keys_table=keys_table,
+        keys=", ".join(keys),
+        table=table,
+        any_null=" OR ".join("{} IS NULL".format(key) for key in keys),
+        matches=" AND ".join("{0}.{1} = batch.{1}".format(table, key) for key in keys),
+    )
+    inserted = changed = 0
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start : start + batch_size]
+        conn.execute("DELETE FROM {}".format(keys_table))
+        key_columns = batch[list(primary_keys)]
+        _execute_in_batches(
+            conn, _insert_sql(key_columns, keys_table), key_columns, batch_size, None
+        )
+        inserted += conn.execute(count_sql).fetchone()[0]
+        changes_before = conn.total_changes
+        _execute_in_batches(conn, sql, batch, batch_size, progress)
+        changed += conn.total_changes - changes_before
+    conn.execute("DROP TABLE temp.{}".format(keys_table))
+    return inserted, changed - inserted, len(df) - changed
+
+
+def _quote(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def _insert_sql(df, table_name):
+    return "INSERT INTO {} ({}) VALUES ({})".format(
+        _quote(table_name),
+        ", ".join(_quote(column) for column in df),
+        ", ".join("?" for column in df.columns),
+    )
+
+
+def _execute_in_batches(conn, sql, df, batch_size, progress):
+    _register_date_adapters()
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start : start + batch_size]
+        columns = [_sqlite_values(batch.iloc[:, i]) for i in range(batch.shape[1])]
+        conn.executemany(sql, zip(*columns))
+        if progress is not None:
+            progress(len(batch))
+
+
+def _sqlite_values(series):
+    # Returns a list of the values in series that sqlite3 can bind
+    if isinstance(series.dtype, ARROW_DTYPES):
+        # Straight from the Arrow array, with None for nulls
+        return series.array.__arrow_array__().to_pylist()
+    kind = series.dtype.kind
+    if kind == "M":
+        if isinstance(series.array, pd.arrays.DatetimeArray):
+            values = series.array.to_pydatetime()
+        else:
+            values = series.to_numpy(dtype=object)
+    elif kind == "m":
+        # Like pandas, store timedeltas as integers in their own unit
+        return series.to_numpy().view("i8").tolist()
+    elif kind in "iub":
+        # No missing values to replace, and tolist() gives Python scalars
+        return series.to_numpy().tolist()
+    elif kind == "f" and isinstance(series.dtype, np.dtype):
+        floats = series.to_numpy()
+        values = floats.astype(object)
+        values[np.isnan(floats)] = None
+        return values.tolist()
+    else:
+        values = series.to_numpy(dtype=object, copy=True)
+    values[pd.isna(values)] = None
+    return values.tolist()
+
+
+_date_adapters_registered = False
+
+
+def _register_date_adapters():
+    # The same adapters pandas.to_sql() registers for SQLite connections
+    global _date_adapters_registered
+    if _date_adapters_registered:
+        return
+
+    def adapt_time(t):
+        return "{:02d}:{:02d}:{:02d}.{:06d}".format(
+            t.hour, t.minute, t.second, t.microsecond
+        )
+
+    sqlite3.register_adapter(datetime.time, adapt_time)
+    sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+    sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+    _date_adapters_registered = True
+
+
+SqliteCapabilities = collections.namedtuple(
+    "SqliteCapabilities",
+    ("version", "fts_versions", "json1", "upsert", "returning", "max_variables"),
+)
+
+_sqlite_capabilities = None
+
+
+def sqlite_capabilities():
+    """Probes what the SQLite library Python is linked against can do
+
+    The probes run once per process - every later call returns the same
+    SqliteCapabilities, which has:
+
+    - version: tuple of ints, e.g. (3, 45, 1)
+    - fts_versions: the supported FTS versions, most advanced first
+    - json1: True if the JSON functions are available
+    - upsert: True if INSERT ... ON CONFLICT DO UPDATE is supported
+    - returning: True if INSERT ... RETURNING is supported
+    - max_variables: the most ? parameters allowed in one statement
+    """
+    global _sqlite_capabilities
+    if _sqlite_capabilities is not None:
+        return _sqlite_capabilities
+    conn = sqlite3.connect(":memory:")
+    try:
+        fts_versions = []
+        for fts in ("FTS5", "FTS4", "FTS3"):
+            try:
+                conn.execute("CREATE VIRTUAL TABLE v_{0} USING {0} (t)".format(fts))
+                fts_versions.append(fts)
+            except sqlite3.OperationalError:
+                continue
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, value TEXT)")
+
+        def supported(sql):
+            try:
+                conn.execute(sql).fetchall()
+                return True
+            except sqlite3.OperationalError:
+                return False
+
+        _sqlite_capabilities = SqliteCapabilities(
+            version=sqlite3.sqlite_version_info,
+            fts_versions=tuple(fts_versions),
+            json1=supported("SELECT json('{}')"),
+            upsert=supported(
+                "INSERT INTO t VALUES (1, 'a') "
+                "ON CONFLICT (id) DO UPDATE SET value = excluded.value"
+            ),
+            returning=supported("INSERT INTO t (value) VALUES ('b') RETURNING id"),
+            max_variables=_max_variables(conn),
+        )
+    finally:
+        conn.close()
+    return _sqlite_capabilities
+
+
+def _max_variables(conn):
+    if hasattr(conn, "getlimit"):
+        # Python 3.11+
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    for (option,) in conn.execute("PRAGMA compile_options"):
+        if option.startswith("MAX_VARIABLE_NUMBER="):
+            return int(option.split("=", 1)[1])
+    # The compiled in default, which was raised in SQLite 3.32.0
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
 
 
 def best_fts_version():
     "Discovers the most advanced supported SQLite FTS version"
-    conn = sqlite3.connect(":memory:")
-    for fts in ("FTS5", "FTS4", "FTS3"):
-        try:
-            conn.execute("CREATE VIRTUAL TABLE v USING {} (t);".format(fts))
-            return fts
-        except sqlite3.OperationalError:
-            continue
-    return None
+    fts_versions = sqlite_capabilities().fts_versions
+    return fts_versions[0] if fts_versions else None
+
 
+DEFAULT_FTS_BATCH_SIZE = 100000
 
-def generate_and_populate_fts(conn, created_tables, cols, foreign_keys):
+# FTS5 settings used while a full-text index is bulk loaded: no incremental
+# merging, and a high limit before segments are forcibly merged. The index
+# is merged with 'optimize' at the end and the defaults are then restored.
+FTS5_BULK_LOAD_CONFIG = (("automerge", 0), ("crisismerge", 64))
+FTS5_DEFAULT_CONFIG = (("automerge", 4), ("crisismerge", 16))
+
+
+def generate_and_populate_fts(
+    conn,
+    created_tables,
+    cols,
+    foreign_keys,
+    batch_size=DEFAULT_FTS_BATCH_SIZE,
+    progress=None,
+):
+    """
+    Creates a <table>_fts index for each table and populates it, batch_size
+    rows at a time in rowid order. If provided, progress(table, done, total)
+    is called after every batch.
+    """
     fts_version = best_fts_version()
-    sql = []
     fts_cols = ", ".join('"{}"'.format(c) for c in cols)
     for table in created_tables:
-        sql.append(
+        conn.execute(
             'CREATE VIRTUAL TABLE "{content_table}_fts" USING {fts_version} ({cols}, content="{content_table}")'.format(
                 cols=fts_cols, content_table=table, fts_version=fts_version
             )
@@ -430,12 +2296,144 @@ def generate_and_populate_fts(conn, created_tables, cols, foreign_keys):
                 content_table=table,
                 joins="\n".join(joins),
             )
-        sql.append(
-            'INSERT INTO "{content_table}_fts" (rowid, {cols}) {select}'.format(
-                cols=fts_cols, content_table=table, select=select
+        insert_sql = 'INSERT INTO "{content_table}_fts" (rowid, {cols}) {select} WHERE [{content_table}].rowid >= ? AND [{content_table}].rowid < ?'.format(
+            cols=fts_cols, content_table=table, select=select
+        )
+        if fts_version == "FTS5":
+            _configure_fts5(conn, table, FTS5_BULK_LOAD_CONFIG)
+        total, start, max_rowid = conn.execute(
+            "SELECT count(*), min(rowid), max(rowid) FROM [{}]".format(table)
+        ).fetchone()
+        done = 0
+        while start is not None:
+            # Rowids can have gaps, so find where the next batch starts
+            row = conn.execute(
+                "SELECT rowid FROM [{}] WHERE rowid >= ? ORDER BY rowid LIMIT 1 OFFSET ?".format(
+                    table
+                ),
+                (start, batch_size),
+            ).fetchone()
+            next_start = row[0] if row else None
+            end = next_start if row else max_rowid + 1
+            done += conn.execute(insert_sql, (start, end)).rowcount
+            if progress is not None:
+                progress(table, done, total)
+            start = next_start
+        if fts_version == "FTS5":
+            conn.execute(
+                'INSERT INTO "{table}_fts" ("{table}_fts") VALUES (\'optimize\')'.format(
+                    table=table
+                )
+            )
+            _configure_fts5(conn, table, FTS5_DEFAULT_CONFIG)
+
+
+def populate_fts_in_separate_database(
+    dbname, table, cols, foreign_keys, directory=None
+):
+    """
+    Builds the <table>_fts index for a table in dbname in a new temporary
+    database file, ready to be copied in using copy_fts_from_database().
+    Returns (path to that file, number of rows indexed).
+
+    Module level function so it can be run in a worker process. dbname must
+    be readable by other connections while this runs - see
+    concurrent_readers().
+    """
+    fd, path = tempfile.mkstemp(
+        prefix="csvs-to-sqlite-fts-", suffix=".db", dir=directory
+    )
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    rows = []
+    try:
+        # Only the full-text index is created in this database, so the
+        # content table and lookup tables are found in the attached one
+        conn.execute("ATTACH DATABASE ? AS source", (dbname,))
+        generate_and_populate_fts(
+            conn,
+            [table],
+            cols,
+            foreign_keys,
+            progress=lambda table, done, total: rows.append(done),
+        )
+        conn.commit()
+    except Exception:
+        conn.close()
+        os.remove(path)
+        raise
+    conn.close()
+    return path, rows[-1] if rows else 0
+
+
+def copy_fts_from_database(conn, path, table):
+    """
+    Copies the <table>_fts index built by populate_fts_in_separate_database()
+    into conn, by creating an empty index and then copying the rows of each
+    of its shadow tables. Commits, and deletes the file at path afterwards.
+    """
+    fts_table = "{}_fts".format(table)
+    # ATTACH and DETACH cannot be used inside a transaction
+    conn.commit()
+    conn.execute("ATTACH DATABASE ? AS fts_build", (path,))
+    try:
+        conn.execute(
+            conn.execute(
+                "SELECT sql FROM fts_build.sqlite_master WHERE name = ?", (fts_table,)
+            ).fetchone()[0]
+        )
+        shadow_tables = [
+            row[0]
+            for row in conn.execute(
+                "SELECT name FROM fts_build.sqlite_master WHERE type = 'table' "
+                "AND substr(name, 1, ?) = ?",
+                (len(fts_table) + 1, fts_table + "_"),
+            )
+        ]
+        for shadow_table in shadow_tables:
+            conn.execute('DELETE FROM main."{}"'.format(shadow_table))
+            conn.execute(
+                'INSERT INTO main."{table}" SELECT * FROM fts_build."{table}"'.format(
+                    table=shadow_table
+                )
             )
+        conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE fts_build")
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def concurrent_readers(conn):
+    """
+    Commits, then switches conn to WAL journaling with normal locking for the
+    duration of the with block, so that other processes can read everything
+    written so far while conn carries on writing. The previous settings are
+    put back afterwards.
+    """
+    conn.commit()
+    locking_mode = conn.execute("PRAGMA locking_mode").fetchone()[0]
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.execute("PRAGMA locking_mode = NORMAL")
+    # Leaving EXCLUSIVE locking mode only releases the lock on next access
+    conn.execute("select count(*) from sqlite_master").fetchall()
+    conn.execute("PRAGMA journal_mode = WAL")
+    try:
+        yield
+    finally:
+        conn.commit()
+        conn.execute("PRAGMA journal_mode = {}".format(journal_mode))
+        conn.execute("PRAGMA locking_mode = {}".format(locking_mode))
+
+
+def _configure_fts5(conn, table, config):
+    for option, value in config:
+        conn.execute(
+            'INSERT INTO "{table}_fts" ("{table}_fts", rank) VALUES (?, ?)'.format(
+                table=table
+            ),
+            (option, value),
         )
-    conn.executescript(";\n".join(sql))
 
 
 type_re = re.compile(r"\((real|integer|text|blob|numeric)\)$", re.I)
@@ -484,7 +2482,18 @@ def apply_shape(df, shape):
     if renames:
         df.rename(columns=renames, inplace=True)
     # Return type overrides, if any
-    return {d["db_name"]: d["type_override"] for d in defns if d["type_override"]}
+    return shape_type_overrides(shape)
+
+
+def shape_type_overrides(shape):
+    # Returns dtype= arg for to_sql, without needing a DataFrame
+    if not shape:
+        return None
+    return {
+        d["db_name"]: d["type_override"]
+        for d in parse_shape(shape)
+        if d["type_override"]
+    }
 
 
 def add_index(conn, table_name, index):
@@ -492,7 +2501,9 @@ def add_index(conn, table_name, index):
     # Figure out columns in table so we can sanity check this
     cursor = conn.execute("select * from [{}] limit 0".format(table_name))
     columns = [r[0] for r in cursor.description]
-    if all([(c in columns) for c in columns_to_index]):
+    if all([(c in columns) for c in columns_to_index]) and (
+        columns_to_index not in existing_indexes(conn, table_name)
+    ):
         sql = 'CREATE INDEX ["{}_{}"] ON [{}]("{}");'.format(
             table_name,
             "_".join(columns_to_index),
@@ -502,17 +2513,145 @@ def add_index(conn, table_name, index):
         conn.execute(sql)
 
 
+def existing_indexes(conn, table_name):
+    "Returns the list of columns covered by each index on the table"
+    return [
+        [info[2] for info in conn.execute("PRAGMA index_info([{}])".format(index_name))]
+        for _, index_name, *_ in conn.execute(
+            "PRAGMA index_list([{}])".format(table_name)
+        )
+    ]
+
+
+# SQLite can use this many helper threads to sort rows while building indexes
+INDEX_BUILD_THREADS = min(os.cpu_count() or 1, 8)
+
+
+def add_indexes(conn, table_name, indexes):
+    """
+    Builds indexes on a table after all of its rows have been inserted,
+    skipping any that duplicate an index the table already has.
+    """
+    row = conn.execute("PRAGMA threads").fetchone()
+    if row is not None and row[0] < INDEX_BUILD_THREADS:
+        conn.execute("PRAGMA threads = {}".format(INDEX_BUILD_THREADS))
+    try:
+        for index in indexes:
+            add_index(conn, table_name, index)
+    finally:
+        if row is not None:
+            conn.execute("PRAGMA threads = {}".format(row[0]))
+
+
 def apply_dates_and_datetimes(df, date_cols, datetime_cols, datetime_formats):
-    def parse_datetime(datestring, force_date=False):
-        if pd.isnull(datestring):
-            return datestring
-        dt = dateparser.parse(datestring, date_formats=datetime_formats)
+    # Returns {column: (distinct values, values that needed dateparser)}
+    stats = {}
+    for date_col in date_cols:
+        df[date_col], stats[date_col] = parse_dates(
+            df[date_col], datetime_formats, force_date=True
+        )
+    for datetime_col in datetime_cols:
+        df[datetime_col], stats[datetime_col] = parse_dates(
+            df[datetime_col], datetime_formats
+        )
+    return stats
+
+
+def parse_dates(series, datetime_formats, force_date=False, sample_size=5):
+    """Converts a series of date strings to ISO format
+
+    Each distinct value is parsed once. Values are first tried against the
+    datetime_formats using pd.to_datetime() - or if there are none, against
+    formats guessed from a sample of the values, so long as dateparser agrees
+    with them on that sample. Anything left over is parsed by dateparser.
+
+    Returns (series, (number of distinct values, number parsed by dateparser))
+    """
+
+    def to_iso(dt):
         if force_date:
             return dt.date().isoformat()
         else:
             return dt.isoformat()
 
-    for date_col in date_cols:
-        df[date_col] = df[date_col].apply(lambda s: parse_datetime(s, force_date=True))
-    for datetime_col in datetime_cols:
-        df[datetime_col] = df[datetime_col].apply(parse_datetime)
+    def slow_parse(datestring):
+        return to_iso(dateparser.parse(datestring, date_formats=datetime_formats))
+
+    uniques = pd.unique(series.dropna())
+    parsed = {}
+    remaining = [v for v in uniques if isinstance(v, six.string_types)]
+    # pd.to_datetime() fills in a missing year or day differently from
+    # dateparser, so those formats are left to dateparser
+    formats = [(f, False) for f in datetime_formats if _is_complete_date_format(f)]
+    if not formats and remaining:
+        formats = _guess_date_formats(remaining[:sample_size])
+    for date_format, check_ambiguous in formats:
+        if not remaining:
+            break
+        for value, dt in _parse_with_format(remaining, date_format, check_ambiguous):
+            parsed[value] = to_iso(dt)
+        remaining = [v for v in remaining if v not in parsed]
+    slow = [v for v in uniques if v not in parsed]
+    for value in slow:
+        parsed[value] = slow_parse(value)
+    return series.map(parsed), (len(uniques), len(slow))
+
+
+def _guess_date_formats(sample):
+    # Returns [(format, check_ambiguous)] for formats that dateparser agrees with
+    guesses = []
+    for value in sample:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            guess = guess_datetime_format(value)
+        if guess and _is_complete_date_format(guess) and guess not in guesses:
+            guesses.append(guess)
+    formats = []
+    for guess in guesses:
+        # dateparser reads ambiguous numeric dates month first, so if a format
+        # puts the day first then ambiguous values must go to dateparser
+        check_ambiguous = "%d" in guess and "%m" in guess
+        check_ambiguous = check_ambiguous and guess.index("%d") < guess.index("%m")
+        matches = _parse_with_format(sample, guess, check_ambiguous)
+        try:
+            agrees = all(dateparser.parse(value) == dt for value, dt in matches)
+        except TypeError:
+            # Comparing naive and timezone aware datetimes
+            agrees = False
+        if matches and agrees:
+            formats.append((guess, check_ambiguous))
+    return formats
+
+
+def _is_complete_date_format(date_format):
+    # Without a year pd.to_datetime() gives 1900 where dateparser gives the
+    # current year, and without a day it gives the 1st where dateparser gives
+    # today's day of the month
+    has_year = "%Y" in date_format or "%y" in date_format
+    has_day = "%d" in date_format or "%-d" in date_format or "%j" in date_format
+    return has_year and has_day
+
+
+def _parse_with_format(values, date_format, check_ambiguous=False):
+    # Returns [(value, datetime)] for the values that match date_format
+    def to_datetime(date_format):
+        return pd.to_datetime(
+            pd.Series(values, dtype=object), format=date_format, errors="coerce"
+        )
+
+    try:
+        parsed = to_datetime(date_format)
+        if check_ambiguous:
+            swapped = (
+                date_format.replace("%d", "\0").replace("%m", "%d").replace("\0", "%m")
+            )
+            other = to_datetime(swapped)
+            parsed = parsed.where(other.isnull() | (other == parsed))
+    except (ValueError, TypeError):
+        # e.g. values with a mixture of timezone offsets
+        return []
+    return [
+        (value, dt.to_pydatetime())
+        for value, dt in zip(values, parsed)
+        if not pd.isnull(dt)
+    ]
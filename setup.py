@@ -26,10 +26,13 @@ setup(
         "click>=7.0",
         "dateparser>=1.0",
         "pandas>=1.0",
-        "py-lru-cache~=0.1.4",
         "six",
     ],
-    extras_require={"test": ["pytest", "cogapp"]},
+    extras_require={
+        "test": ["pytest", "cogapp"],
+        "pyarrow": ["pyarrow"],
+        "zstd": ["zstandard"],
+    },
     entry_points="""
         [console_scripts]
         csvs-to-sqlite=csvs_to_sqlite.cli:cli
@@ -0,0 +1,42 @@
+import importlib.util
+import pathlib
+import pandas as pd
+
+spec = importlib.util.spec_from_file_location(
+    "benchmark", pathlib.Path(__file__).parent.parent / "benchmarks" / "benchmark.py"
+)
+benchmark = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(benchmark)
+
+
+def test_generate_csv(tmpdir):
+    path = str(tmpdir / "test.csv")
+    headers = benchmark.generate_csv(
+        path,
+        100,
+        columns=7,
+        cardinality=5,
+        date_format="%d/%m/%Y",
+        encoding="latin-1",
+        null_ratio=0.5,
+    )
+    assert ["id", "category", "name", "date", "int_0", "float_1", "text_2"] == headers
+    df = pd.read_csv(path, encoding="latin-1")
+    assert list(df.columns) == headers
+    assert list(df.id) == list(range(100))
+    assert df.category.nunique() <= 5
+    assert 20 < df.category.isnull().sum() < 80
+    assert pd.to_datetime(df.date.dropna(), format="%d/%m/%Y").notnull().all()
+
+
+def test_run_scenario(tmpdir):
+    result = benchmark.run_scenario("extract-column", 100, 5, str(tmpdir))
+    assert 100 == result["rows"]
+    assert result["rows_per_second"] > 0
+    assert "refactor_dataframes" in result["stages"]
+    baseline = dict(result, rows_per_second=result["rows_per_second"] * 2)
+    lines, regressions = benchmark.compare(
+        {"extract-column": result}, {"extract-column": baseline}, 0.1
+    )
+    assert ["extract-column"] == regressions
+    assert lines[1].endswith("-50.0% !")
@@ -4,8 +4,17 @@ from six import string_types, text_type
 from cogapp import Cog
 import sys
 from io import StringIO
+import bz2
+import functools
+import gzip
+import http.server
+import json
+import lzma
 import pathlib
+import pytest
 import sqlite3
+import threading
+import zipfile
 
 CSV = """county,precinct,office,district,party,candidate,votes
 Yolo,100001,President,,LIB,Gary Johnson,41
@@ -45,6 +54,7 @@ def test_flat():
         result = runner.invoke(cli.cli, ["test.csv", "test.db"])
         assert result.exit_code == 0
         assert result.output.strip().endswith("Created test.db from 1 CSV file")
+        assert "Reading test.csv as utf8" in result.output
         conn = sqlite3.connect("test.db")
         assert [
             (0, "county", "TEXT", 0, None, 0),
@@ -172,6 +182,7 @@ def test_fts():
             cli.cli, "test.csv fts.db -f office -f party -f candidate".split()
         )
         assert result.exit_code == 0
+        assert 1 == result.output.count("Populated full-text index for test: 6 rows")
         conn = sqlite3.connect("fts.db")
         assert (
             [("Yolo", 100001, "President", "PAF", "Gloria Estela La Riva")]
@@ -315,6 +326,52 @@ def test_shape():
             assert isinstance(votes, float)
 
 
+def test_exclude_column():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        result = runner.invoke(
+            cli.cli,
+            [
+                "test.csv",
+                "test.db",
+                "--exclude-column",
+                "precinct",
+                "--exclude-column",
+                "district",
+                "-c",
+                "office",
+            ],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect("test.db")
+        assert ["county", "office", "party", "candidate", "votes"] == [
+            row[1] for row in conn.execute("PRAGMA table_info(test)")
+        ]
+        assert ("Yolo", 1, "LIB", "Gary Johnson", 41) == conn.execute(
+            "select * from test"
+        ).fetchone()
+
+
+def test_exclude_column_used_by_another_option():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        result = runner.invoke(
+            cli.cli,
+            ["test.csv", "test.db", "--exclude-column", "candidate", "-f", "candidate"],
+        )
+        assert result.exit_code == 2
+        assert "candidate is used by --fts but excluded by --exclude-column" in (
+            result.output
+        )
+        result = runner.invoke(
+            cli.cli, ["test.csv", "test.db", "--shape", "county:Cty", "-i", "county"]
+        )
+        assert result.exit_code == 2
+        assert "county is used by --index but is not in --shape" in result.output
+
+
 def test_filename_column():
     runner = CliRunner()
     with runner.isolated_filesystem():
@@ -572,6 +629,24 @@ def test_custom_indexes():
         ).fetchall()
 
 
+def test_indexes_built_once_after_load():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        open("test2.csv", "w").write(CSV)
+        args = ["-t", "combined", "-c", "office", "-i", "office", "-i", "county"]
+        result = runner.invoke(cli.cli, ["test.csv", "test2.csv", "test.db"] + args)
+        assert result.exit_code == 0
+        # Appending to the table again does not try to recreate the indexes
+        result = runner.invoke(cli.cli, ["test.csv", "test.db"] + args)
+        assert result.exit_code == 0
+        conn = sqlite3.connect("test.db")
+        assert [('"combined_county"',), ('"combined_office"',)] == conn.execute(
+            'select name from sqlite_master where type = "index" order by name'
+        ).fetchall()
+        assert 18 == conn.execute("select count(*) from combined").fetchone()[0]
+
+
 def test_dates_and_datetimes():
     runner = CliRunner()
     with runner.isolated_filesystem():
@@ -587,6 +662,7 @@ def test_dates_and_datetimes():
         ]
         actual = conn.execute("select * from test").fetchall()
         assert expected == actual
+        assert "Parsed 2 distinct date values in date, " in result.output
 
 
 def test_dates_custom_formats():
@@ -766,6 +842,723 @@ def test_just_strings_with_date_specified():
             assert isinstance(gross, text_type)
 
 
+def test_chunk_size():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        open("test2.csv", "w").write(CSV)
+        args = [
+            "test.csv",
+            "test2.csv",
+            "-t",
+            "combined",
+            "--filename-column",
+            "source",
+            "-c",
+            "office",
+            "-c",
+            "candidate",
+            "-i",
+            "county",
+            "-f",
+            "candidate",
+        ]
+        result = runner.invoke(cli.cli, args + ["whole.db"])
+        assert result.exit_code == 0
+        result = runner.invoke(cli.cli, args + ["chunked.db", "--chunk-size", "4"])
+        assert result.exit_code == 0
+        assert result.output.strip().endswith("Created chunked.db from 2 CSV files")
+        whole = sqlite3.connect("whole.db")
+        chunked = sqlite3.connect("chunked.db")
+        for sql in (
+            "select * from sqlite_master order by name",
+            "select rowid, * from combined",
+            "select * from office",
+            "select * from candidate",
+            "select rowid, * from combined_fts where combined_fts match 'gary'",
+        ):
+            assert whole.execute(sql).fetchall() == chunked.execute(sql).fetchall()
+        assert 12 == chunked.execute("select count(*) from combined").fetchone()[0]
+
+
+def test_chunk_size_rolls_back_failed_files():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        # Well past the samples detect_encoding() takes from each end
+        rows = ["{},Alice".format(i) for i in range(300000)]
+        rows[150000] = "150000,Zoë"
+        with open("latin1.csv", "wb") as fp:
+            fp.write("id,name\n{}\n".format("\n".join(rows)).encode("latin-1"))
+        # Its first chunk is written before the bad line is reached
+        with open("broken.csv", "w") as fp:
+            fp.write(
+                "id,name\n{}\n1,Bob,extra\n".format(
+                    "\n".join("{},Bob".format(i) for i in range(150000))
+                )
+            )
+        result = runner.invoke(
+            cli.cli,
+            [
+                "latin1.csv",
+                "broken.csv",
+                "test.db",
+                "-c",
+                "name",
+                "--chunk-size",
+                "100000",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "Could not read latin1.csv as utf8, starting again" in result.output
+        assert "Reading latin1.csv as latin-1" in result.output
+        assert "Could not load broken.csv" in result.output
+        assert result.output.strip().endswith("Created test.db from 1 CSV file")
+        conn = sqlite3.connect("test.db")
+        assert 300000 == conn.execute("select count(*) from latin1").fetchone()[0]
+        assert [(1, "Alice"), (2, "Zoë")] == conn.execute(
+            "select id, value from name order by id"
+        ).fetchall()
+        assert not conn.execute(
+            "select name from sqlite_master where name = 'broken'"
+        ).fetchall()
+        assert not conn.execute("select * from name where value = 'Bob'").fetchall()
+
+
+def test_pyarrow_engine():
+    pytest.importorskip("pyarrow")
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        open("dates.csv", "w").write(CSV_DATES)
+        open("strings.csv", "w").write(CSV_STRINGS_AND_DATES)
+        open("nulls.csv", "w").write("id,empty,name\n1,,Cleo\n2,,Pancakes\n")
+        for i, args in enumerate(
+            (
+                ["test.csv", "-c", "office", "-c", "candidate", "-f", "candidate"],
+                ["test.csv", "--shape", "votes:Vts(REAL),county:Cty,district"],
+                ["test.csv", "--just-strings", "--shape", "county:Cty,district"],
+                ["dates.csv", "--date", "date", "--datetime", "datetime"],
+                [
+                    "strings.csv",
+                    "--date",
+                    "release_date",
+                    "--datetime-format",
+                    "%d of %B in the year %Y",
+                    "--just-strings",
+                ],
+                ["nulls.csv"],
+                ["nulls.csv", "--just-strings"],
+            )
+        ):
+            for engine in ("c", "pyarrow"):
+                dbname = "{}-{}.db".format(engine, i)
+                result = runner.invoke(cli.cli, args + [dbname, "--engine", engine])
+                assert result.exit_code == 0, result.output
+            c = sqlite3.connect("c-{}.db".format(i))
+            pyarrow = sqlite3.connect("pyarrow-{}.db".format(i))
+            tables = [
+                row[0]
+                for row in c.execute(
+                    "select name from sqlite_master where type='table'"
+                )
+            ]
+            for sql in ["select * from sqlite_master order by name"] + [
+                "select * from [{}]".format(table) for table in tables
+            ]:
+                assert c.execute(sql).fetchall() == pyarrow.execute(sql).fetchall()
+
+
+def test_pyarrow_engine_compressed_url(http_server):
+    pytest.importorskip("pyarrow")
+    directory, url = http_server
+    with gzip.open(str(directory / "remote.csv.gz"), "wt") as fp:
+        fp.write(CSV)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        for engine in ("c", "pyarrow"):
+            result = runner.invoke(
+                cli.cli,
+                [url + "remote.csv.gz", engine + ".db", "--engine", engine],
+            )
+            assert result.exit_code == 0, result.output
+        c = sqlite3.connect("c.db")
+        pyarrow = sqlite3.connect("pyarrow.db")
+        assert 6 == len(c.execute("select * from remote").fetchall())
+        assert c.execute("select * from remote").fetchall() == (
+            pyarrow.execute("select * from remote").fetchall()
+        )
+
+
+def test_pyarrow_engine_skip_errors():
+    pytest.importorskip("pyarrow")
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("bad.csv", "w").write("id,name\n1,Cleo\n2,Pancakes,extra\n3,Bailey\n")
+        result = runner.invoke(cli.cli, ["bad.csv", "bad.db", "--engine", "pyarrow"])
+        assert "Could not load bad.csv" in result.output
+        result = runner.invoke(
+            cli.cli, ["bad.csv", "bad.db", "--engine", "pyarrow", "--skip-errors"]
+        )
+        assert result.exit_code == 0
+        assert [(1, "Cleo"), (3, "Bailey")] == sqlite3.connect("bad.db").execute(
+            "select * from bad"
+        ).fetchall()
+
+
+def test_compact():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        args = ["test.csv", "-c", "office", "-c", "party", "-f", "candidate"]
+        result = runner.invoke(cli.cli, args + ["default.db"])
+        assert result.exit_code == 0
+        result = runner.invoke(cli.cli, args + ["compact.db", "--compact"])
+        assert result.exit_code == 0
+        default = sqlite3.connect("default.db")
+        compact = sqlite3.connect("compact.db")
+        for sql in (
+            "select * from sqlite_master order by name",
+            "select rowid, * from test",
+            "select * from office",
+            "select * from party",
+        ):
+            assert default.execute(sql).fetchall() == compact.execute(sql).fetchall()
+
+
+def test_fast_and_pragmas():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        result = runner.invoke(
+            cli.cli,
+            [
+                "test.csv",
+                "test.db",
+                "-c",
+                "office",
+                "--fast",
+                "--pragma",
+                "page_size=8192",
+            ],
+        )
+        assert result.exit_code == 0
+        conn = sqlite3.connect("test.db")
+        assert 8192 == conn.execute("PRAGMA page_size").fetchone()[0]
+        assert "delete" == conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert 6 == conn.execute("select count(*) from test").fetchone()[0]
+        assert 3 == conn.execute("select count(*) from office").fetchone()[0]
+
+
+def test_invalid_pragma():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        result = runner.invoke(cli.cli, ["test.csv", "test.db", "--pragma", "nope"])
+        assert result.exit_code == 2
+        assert "PRAGMA must be in the format name=value" in result.output
+
+
+def test_jobs():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        pathlib.Path("csvs/nested").mkdir(parents=True)
+        open("csvs/one.csv", "w").write(CSV)
+        open("csvs/nested/two.csv", "w").write(CSV_DATES)
+        open("csvs/three.csv", "w").write(CSV_MULTI)
+        open("csvs/four.csv", "w").write("")
+        args = ["csvs", "-c", "party", "-c", "film", "--filename-column", "source"]
+        result = runner.invoke(cli.cli, args + ["serial.db"])
+        assert result.exit_code == 0
+        result = runner.invoke(cli.cli, args + ["parallel.db", "--jobs", "2"])
+        assert result.exit_code == 0
+        assert "Could not load csvs/four.csv" in result.output
+        serial = sqlite3.connect("serial.db")
+        parallel = sqlite3.connect("parallel.db")
+        sql = "select name, sql from sqlite_master order by name"
+        assert serial.execute(sql).fetchall() == parallel.execute(sql).fetchall()
+        for table in ("./one", "./three", "nested/two", "party", "film"):
+            sql = "select * from [{}]".format(table)
+            assert serial.execute(sql).fetchall() == parallel.execute(sql).fetchall()
+
+
+def test_compressed_csvs():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        pathlib.Path("csvs/nested").mkdir(parents=True)
+        open("test.csv", "w").write(CSV)
+        with gzip.open("csvs/one.csv.gz", "wt") as fp:
+            fp.write(CSV)
+        with bz2.open("csvs/nested/two.csv.bz2", "wt") as fp:
+            fp.write(CSV)
+        with lzma.open("three.csv.xz", "wb") as fp:
+            fp.write("film,title\n1,Café Society\n".encode("latin-1"))
+        assert runner.invoke(cli.cli, ["test.csv", "expected.db"]).exit_code == 0
+        expected = sqlite3.connect("expected.db")
+        for args in ([], ["--chunk-size", "4"]):
+            result = runner.invoke(
+                cli.cli, ["csvs", "three.csv.xz", "test.db", "--replace-tables"] + args
+            )
+            assert result.exit_code == 0, result.output
+            assert "Reading three.csv.xz as latin-1" in result.output
+            conn = sqlite3.connect("test.db")
+            assert {"./one", "nested/two", "three"} == {
+                row[0] for row in conn.execute("select name from sqlite_master")
+            }
+            for table in ("./one", "nested/two"):
+                assert expected.execute("select * from test").fetchall() == (
+                    conn.execute("select * from [{}]".format(table)).fetchall()
+                )
+            assert [(1, "Café Society")] == conn.execute(
+                "select * from three"
+            ).fetchall()
+
+
+def test_compressed_csv_with_late_latin1_byte():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        # Only the start of a compressed file is sampled by detect_encoding()
+        rows = ["{},Alice".format(i) for i in range(200000)]
+        rows[-1] = "199999,Zoë"
+        with gzip.open("test.csv.gz", "wb") as fp:
+            fp.write("id,name\n{}\n".format("\n".join(rows)).encode("latin-1"))
+        result = runner.invoke(
+            cli.cli, ["test.csv.gz", "test.db", "--chunk-size", "50000"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Could not read test.csv.gz as utf8, starting again" in result.output
+        assert "Reading test.csv.gz as latin-1" in result.output
+        conn = sqlite3.connect("test.db")
+        assert 200000 == conn.execute("select count(*) from test").fetchone()[0]
+        assert [("Zoë",)] == conn.execute(
+            "select name from test where id = 199999"
+        ).fetchall()
+
+
+def test_compressed_and_uncompressed_csvs_with_the_same_name():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        pathlib.Path("csvs").mkdir()
+        open("csvs/data.csv", "w").write(CSV)
+        with gzip.open("csvs/data.csv.gz", "wt") as fp:
+            fp.write(CSV_MULTI)
+        result = runner.invoke(cli.cli, ["csvs", "test.db"])
+        assert result.exit_code == 0, result.output
+        assert result.output.strip().endswith("Created test.db from 2 CSV files")
+        conn = sqlite3.connect("test.db")
+        # os.walk() does not say which of the two comes first
+        assert {3, 6} == {
+            conn.execute("select count(*) from [{}]".format(table)).fetchone()[0]
+            for table in ("./data", "./data-1")
+        }
+
+
+def test_zip_archive():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with zipfile.ZipFile("csvs.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("one.csv", CSV)
+            archive.writestr("nested/two.csv", CSV_MULTI)
+            archive.writestr("__MACOSX/._one.csv", b"\x00\x05")
+            archive.writestr("notes.txt", "Not a CSV")
+        for args in ([], ["--chunk-size", "2"], ["--jobs", "2"]):
+            result = runner.invoke(
+                cli.cli,
+                ["csvs.zip", "test.db", "--replace-tables", "-c", "film"] + args,
+            )
+            assert result.exit_code == 0, result.output
+            assert "Reading csvs.zip/nested/two.csv as utf8" in result.output
+            conn = sqlite3.connect("test.db")
+            assert {"./one", "nested/two", "film"} == {
+                row[0]
+                for row in conn.execute(
+                    "select name from sqlite_master "
+                    "where type = 'table' and name not like '%_fts%'"
+                )
+            }
+            assert 6 == conn.execute("select count(*) from [./one]").fetchone()[0]
+            assert [
+                ("The Rock", "Sean Connery"),
+                ("National Treasure", "Nicolas Cage"),
+                ("Troy", "Diane Kruger"),
+            ] == conn.execute(
+                "select film.value, actor_1 from [nested/two] "
+                "join film on [nested/two].film = film.id"
+            ).fetchall()
+
+
+def test_zip_archives_with_the_same_member():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        for filename in ("one.zip", "two.zip"):
+            with zipfile.ZipFile(filename, "w") as archive:
+                archive.writestr("data.csv", CSV)
+        result = runner.invoke(cli.cli, ["one.zip", "two.zip", "test.db"])
+        assert result.exit_code == 0, result.output
+        conn = sqlite3.connect("test.db")
+        for table in ("./data", "./data-1"):
+            assert 6 == conn.execute(
+                "select count(*) from [{}]".format(table)
+            ).fetchone()[0]
+
+
+def test_jobs_cannot_be_combined_with_chunk_size():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        result = runner.invoke(
+            cli.cli, ["test.csv", "test.db", "--jobs", "2", "--chunk-size", "2"]
+        )
+        assert result.exit_code == 2
+        assert "--jobs cannot be combined with --chunk-size" in result.output
+
+
+def test_incremental():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        pathlib.Path("csvs").mkdir()
+        open("csvs/one.csv", "w").write(CSV)
+        open("csvs/two.csv", "w").write(CSV_MULTI)
+        result = runner.invoke(cli.cli, ["csvs", "test.db", "--incremental"])
+        assert result.exit_code == 0
+        assert result.output.strip().endswith("Created test.db from 2 CSV files")
+        result = runner.invoke(cli.cli, ["csvs", "test.db", "--incremental"])
+        assert result.exit_code == 0
+        assert "Skipping 2 unchanged CSV files" in result.output
+        assert result.output.strip().endswith("Added 0 CSV files to test.db")
+        # Change one of the files
+        open("csvs/two.csv", "w").write(CSV_MULTI + "\nHeat,Al Pacino,Robert De Niro")
+        result = runner.invoke(cli.cli, ["csvs", "test.db", "--incremental"])
+        assert result.exit_code == 0
+        assert "Skipping 1 unchanged CSV file" in result.output
+        conn = sqlite3.connect("test.db")
+        assert 6 == conn.execute("select count(*) from [./one]").fetchone()[0]
+        assert 4 == conn.execute("select count(*) from [./two]").fetchone()[0]
+        assert [("./one", "./one", 6), ("./two", "./two", 4)] == conn.execute(
+            "select name, table_name, row_count from _csvs_to_sqlite_files order by name"
+        ).fetchall()
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    "Serves the files in a directory - yields (directory, base URL)"
+
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(QuietHandler, directory=str(tmp_path)),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield tmp_path, "http://127.0.0.1:{}/".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_incremental_url(http_server):
+    directory, url = http_server
+    (directory / "remote.csv").write_text(CSV)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("local.csv", "w").write(CSV)
+        for dbname, args in (
+            ("tables.db", []),
+            ("partitions.db", ["-t", "votes", "--filename-column", "source"]),
+        ):
+            for i in range(3):
+                result = runner.invoke(
+                    cli.cli,
+                    [url + "remote.csv", "local.csv", dbname, "--incremental"] + args,
+                )
+                assert result.exit_code == 0, result.output
+            conn = sqlite3.connect(dbname)
+            if args:
+                assert [("local", 6), ("remote", 6)] == conn.execute(
+                    "select source, count(*) from votes group by source order by source"
+                ).fetchall()
+            else:
+                assert 6 == conn.execute("select count(*) from remote").fetchone()[0]
+                assert 6 == conn.execute("select count(*) from local").fetchone()[0]
+            assert [("remote", 6)] == conn.execute(
+                "select name, row_count from _csvs_to_sqlite_files "
+                "where path like 'http%'"
+            ).fetchall()
+
+
+def test_incremental_zip_archive():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+
+        def write_archive(two):
+            with zipfile.ZipFile("csvs.zip", "w") as archive:
+                archive.writestr("one.csv", CSV)
+                archive.writestr("two.csv", two)
+
+        write_archive(CSV_MULTI)
+        result = runner.invoke(cli.cli, ["csvs.zip", "test.db", "--incremental"])
+        assert result.exit_code == 0, result.output
+        result = runner.invoke(cli.cli, ["csvs.zip", "test.db", "--incremental"])
+        assert result.exit_code == 0, result.output
+        assert "Skipping 2 unchanged CSV files" in result.output
+        # Change one of the members
+        write_archive(CSV_MULTI + "\nHeat,Al Pacino,Robert De Niro")
+        result = runner.invoke(cli.cli, ["csvs.zip", "test.db", "--incremental"])
+        assert result.exit_code == 0, result.output
+        assert "Skipping 1 unchanged CSV file" in result.output
+        conn = sqlite3.connect("test.db")
+        assert 6 == conn.execute("select count(*) from [./one]").fetchone()[0]
+        assert 4 == conn.execute("select count(*) from [./two]").fetchone()[0]
+        assert [("./one", 6), ("./two", 4)] == conn.execute(
+            "select name, row_count from _csvs_to_sqlite_files order by name"
+        ).fetchall()
+
+
+def test_incremental_replaces_filename_column_partitions():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        pathlib.Path("csvs").mkdir()
+        open("csvs/one.csv", "w").write(CSV)
+        open("csvs/two.csv", "w").write(CSV)
+        args = [
+            "csvs",
+            "test.db",
+            "--incremental",
+            "-t",
+            "votes",
+            "--filename-column",
+            "source",
+            "-c",
+            "party",
+            "-f",
+            "candidate",
+        ]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        open("csvs/two.csv", "w").write(CSV.replace("Gary Johnson", "Gary Jonson"))
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        conn = sqlite3.connect("test.db")
+        assert [("./one", 6), ("./two", 6)] == conn.execute(
+            "select source, count(*) from votes group by source"
+        ).fetchall()
+        assert [("./one", "Gary Johnson"), ("./two", "Gary Jonson")] == conn.execute(
+            "select source, candidate from votes where rowid in "
+            "(select rowid from votes_fts where votes_fts match 'gary') "
+            "order by source"
+        ).fetchall()
+
+
+def test_append_only():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        # The last line is still being written
+        open("test.csv", "w").write(CSV + "\nYolo,100002,President,,LIB,Gary")
+        args = ["test.csv", "test.db", "--append-only", "-c", "party"]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0, result.output
+        assert "Leaving the unfinished last line of test.csv" in result.output
+        size = len(CSV) + 1
+        with open("test.csv", "a") as fp:
+            fp.write(" Johnson,12\n")
+            fp.write("Yolo,100002,President,,GRN,Jill Stein,3\n")
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0, result.output
+        assert "Reading test.csv (from byte {}) as utf8".format(size) in result.output
+        conn = sqlite3.connect("test.db")
+        assert [
+            ("Yolo", 100001, "State Assembly", 7, "REP", "Ryan K. Brown", 291),
+            ("Yolo", 100002, "President", None, "LIB", "Gary Johnson", 12),
+            ("Yolo", 100002, "President", None, "GRN", "Jill Stein", 3),
+        ] == conn.execute(
+            "select county, precinct, office, district, party.value, candidate, votes "
+            "from test join party on test.party = party.id order by test.rowid"
+        ).fetchall()[
+            -3:
+        ]
+        assert [(8,)] == conn.execute(
+            "select row_count from _csvs_to_sqlite_files"
+        ).fetchall()
+        # If earlier rows change the whole file is imported again
+        open("test.csv", "w").write(CSV.replace("Yolo", "Napa") + "\n")
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        assert [("Napa", 6)] == conn.execute(
+            "select county, count(*) from test group by county"
+        ).fetchall()
+
+
+def test_upsert():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV_CUSTOM_PRIMARY_KEYS)
+        args = [
+            "test.csv",
+            "test.db",
+            "--upsert",
+            "--primary-key",
+            "pk1",
+            "--primary-key",
+            "pk2",
+            "-f",
+            "name",
+        ]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        open("test.csv", "w").write(
+            "pk1,pk2,name\none,one,11\none,two,120\nthree,one,31"
+        )
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        assert "Upserted into test: 1 inserted, 1 updated, 1 unchanged" in result.output
+        conn = sqlite3.connect("test.db")
+        assert [
+            ("one", "one", 11),
+            ("one", "two", 120),
+            ("two", "one", 21),
+            ("three", "one", 31),
+        ] == conn.execute("select * from test order by rowid").fetchall()
+        # The full-text index is rebuilt to match
+        assert [("three",)] == conn.execute(
+            "select pk1 from test where rowid in "
+            "(select rowid from test_fts where test_fts match '31')"
+        ).fetchall()
+        result = runner.invoke(cli.cli, ["test.csv", "test.db", "--upsert"])
+        assert result.exit_code == 2
+        assert "--upsert needs --primary-key" in result.output
+
+
+def test_upsert_into_new_table():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write("id,name\n1,Cleo\n2,Pancakes\n1,Cleopatra")
+        for args in ([], ["--chunk-size", "1"]):
+            result = runner.invoke(
+                cli.cli,
+                ["test.csv", "test.db", "--upsert", "--primary-key", "id"] + args,
+            )
+            assert result.exit_code == 0, result.output
+            assert (
+                "Upserted into test: 2 inserted, 1 updated, 0 unchanged"
+                in result.output
+            )
+            conn = sqlite3.connect("test.db")
+            assert [(1, "Cleopatra"), (2, "Pancakes")] == conn.execute(
+                "select * from test order by id"
+            ).fetchall()
+            conn.execute("drop table test")
+            conn.commit()
+            conn.close()
+
+
+def test_index_jobs():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("one.csv", "w").write(CSV)
+        open("two.csv", "w").write(CSV)
+        args = ["one.csv", "two.csv", "-c", "party", "-f", "candidate", "-f", "party"]
+        args += ["-i", "votes"]
+        result = runner.invoke(cli.cli, args + ["serial.db"])
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cli.cli, args + ["parallel.db", "--index-jobs", "2", "--fast"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Populated full-text index for two: 6 rows" in result.output
+        serial = sqlite3.connect("serial.db")
+        parallel = sqlite3.connect("parallel.db")
+        for sql in (
+            "select rowid from one_fts where one_fts match 'gary OR dem'",
+            "select rowid from two_fts where two_fts match 'rep'",
+            "select type, name, sql from sqlite_master order by name",
+            "pragma journal_mode",
+        ):
+            assert serial.execute(sql).fetchall() == parallel.execute(sql).fetchall()
+        assert [(1,), (5,)] == parallel.execute(
+            "select rowid from one_fts where one_fts match 'gary OR dem'"
+        ).fetchall()
+        # The temporary databases have been cleaned up
+        assert ["parallel.db", "serial.db"] == sorted(
+            path.name for path in pathlib.Path(".").glob("*.db*")
+        )
+
+
+def test_stats():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("one.csv", "w").write(CSV)
+        open("two.csv", "w").write(CSV)
+        result = runner.invoke(
+            cli.cli,
+            [
+                "one.csv",
+                "two.csv",
+                "test.db",
+                "-c",
+                "party",
+                "-f",
+                "candidate",
+                "--stats",
+                "--stats-json",
+                "stats.json",
+            ],
+        )
+        assert result.exit_code == 0
+        lines = result.output.strip().split("\n")
+        assert lines[-1].startswith("Total: ")
+        insert_rows = [line.split() for line in lines if line.startswith("insert_rows")]
+        assert [["one", "6"], ["two", "6"], ["(total)", "12"]] == [
+            [bits[1], bits[3]] for bits in insert_rows
+        ]
+        assert (
+            "Lookup table party: 4 hits, 4 misses (50.0% hit rate), 4 values cached"
+            in lines
+        )
+        stats = json.load(open("stats.json"))
+        assert [
+            "load_csv",
+            "apply_dates_and_datetimes",
+            "refactor_dataframes",
+            "insert_rows",
+            "add_indexes",
+            "generate_and_populate_fts",
+        ] == [stage["stage"] for stage in stats["stages"]]
+        assert {"seconds", "rows", "rows_per_second", "peak_rss_so_far"}.issubset(
+            stats["stages"][0]
+        )
+        assert [("one", 6), ("two", 6)] == [
+            (record["name"], record["rows"])
+            for record in stats["files"]
+            if record["stage"] == "load_csv"
+        ]
+
+
+def test_progress_without_a_terminal():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.csv", "w").write(CSV)
+        args = ["test.csv", "test.db", "-c", "party", "-f", "candidate", "--progress"]
+        result = runner.invoke(cli.cli, args)
+        assert result.exit_code == 0
+        assert "Reading: 0.0 of 0.0 MB (100%)" in result.output
+        assert [
+            "Extracting: 6 of 6 values (100%)",
+            "Inserting: 6 of 6 rows (100%)",
+            "Indexing test: 6 of 6 rows (100%)",
+        ] == [
+            line.split(",")[0]
+            for line in result.output.split("\n")
+            if line.startswith(("Extracting", "Inserting", "Indexing"))
+        ]
+        assert "Populated full-text index" not in result.output
+        result = runner.invoke(
+            cli.cli, ["test.csv", "test2.db", "--chunk-size", "4", "--progress"]
+        )
+        assert result.exit_code == 0
+        assert "6 rows inserted" in result.output
+
+
 def test_if_cog_needs_to_be_run():
     _stdout = sys.stdout
     sys.stdout = StringIO()
@@ -1,3 +1,5 @@
+import datetime
+import dateparser
 from csvs_to_sqlite import utils
 import pytest
 import sqlite3
@@ -31,6 +33,81 @@ def test_get_create_table_sql():
     assert {"index", "letter", "number"} == set(columns)
 
 
+def test_get_create_table_sql_integer_floats():
+    df = pd.DataFrame(
+        {
+            "ints": [1.0, None, 3.0],
+            "floats": [1.0, None, 3.5],
+            "infinity": [1.0, float("inf"), 2.0],
+        }
+    )
+    sql, columns = utils.get_create_table_sql("t", df, index=False)
+    assert (
+        'CREATE TABLE "t" (\n'
+        '"ints" INTEGER,\n'
+        '  "floats" REAL,\n'
+        '  "infinity" REAL\n'
+        ")"
+    ) == sql
+    # Only the first two rows are checked with type_sample_size=2
+    sql, columns = utils.get_create_table_sql("t", df, index=False, type_sample_size=2)
+    assert '"floats" INTEGER' in sql
+    assert ["ints", "floats", "infinity"] == columns
+
+
+def test_insert_dataframe_matches_to_sql():
+    df = pd.DataFrame(
+        {
+            "ints": [1, 2, 3],
+            "floats": [1.5, None, 3.0],
+            "strings": ["a", None, "c"],
+            "bools": [True, False, True],
+            "datetimes": pd.to_datetime(["2020-01-01 10:00", None, "2021-02-03 00:00"]),
+            "dates": [datetime.date(2020, 1, 1), None, datetime.date(2020, 2, 2)],
+            "nullable": pd.array([1, None, 3], dtype="Int64"),
+            "category": pd.Categorical(["x", None, "y"]),
+        }
+    )
+    expected_conn = sqlite3.connect(":memory:")
+    df.to_sql("t", expected_conn, index=False)
+    conn = sqlite3.connect(":memory:")
+    conn.execute(utils.get_create_table_sql("t", df, index=False)[0])
+    utils.insert_dataframe(conn, df, "t", batch_size=2)
+    sql = "select *, {} from t".format(
+        ", ".join("typeof({})".format(column) for column in df.columns)
+    )
+    assert expected_conn.execute(sql).fetchall() == conn.execute(sql).fetchall()
+    # Nothing is committed, and df itself is left alone
+    assert conn.in_transaction
+    assert df["strings"].isna().sum() == 1
+
+
+def test_upsert_dataframe():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("create table t (id integer primary key, name text, score real)")
+    conn.execute("insert into t values (1, 'Cleo', 5.0), (2, 'Pancakes', 4.0)")
+    df = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "name": ["Cleo", "Pancakes", "Bailey"],
+            "score": [5.0, 2.5, 1],
+        }
+    )
+    assert (1, 1, 1) == utils.upsert_dataframe(conn, df, "t", ["id"], batch_size=2)
+    assert [(1, "Cleo", 5.0), (2, "Pancakes", 2.5), (3, "Bailey", 1.0)] == (
+        conn.execute("select * from t order by id").fetchall()
+    )
+    # With nothing but the primary key, existing rows are left alone
+    assert (1, 0, 2) == utils.upsert_dataframe(
+        conn, pd.DataFrame({"id": [1, 3, 4]}), "t", ["id"]
+    )
+    # A key repeated within a batch is only inserted once
+    assert (1, 1, 0) == utils.upsert_dataframe(
+        conn, pd.DataFrame({"id": [5, 5], "score": [1.0, 2.0]}), "t", ["id"]
+    )
+    assert (5, None, 2.0) == conn.execute("select * from t where id = 5").fetchone()
+
+
 def test_refactor_dataframes():
     df = pd.DataFrame(
         [
@@ -52,3 +129,250 @@ def test_refactor_dataframes():
     assert (
         "   name  score\n" "0     1    0.5\n" "1     1    0.8\n" "2     2    0.7"
     ) == str(dataframe)
+
+
+def test_generate_and_populate_fts_in_batches():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("create table docs (id integer primary key, title text)")
+    conn.executemany(
+        "insert into docs (id, title) values (?, ?)",
+        [(1, "one"), (2, "two"), (10, "ten"), (500, "five hundred"), (501, "one more")],
+    )
+    progress = []
+    utils.generate_and_populate_fts(
+        conn,
+        ["docs"],
+        ["title"],
+        {},
+        batch_size=2,
+        progress=lambda *args: progress.append(args),
+    )
+    assert [("docs", 2, 5), ("docs", 4, 5), ("docs", 5, 5)] == progress
+    assert [(1,), (501,)] == conn.execute(
+        "select rowid from docs_fts where docs_fts match 'one' order by rowid"
+    ).fetchall()
+    if utils.best_fts_version() == "FTS5":
+        # Bulk load settings are put back to the FTS5 defaults afterwards
+        assert [("automerge", 4), ("crisismerge", 16)] == conn.execute(
+            "select k, v from docs_fts_config where k != 'version' order by k"
+        ).fetchall()
+
+
+def test_sqlite_capabilities(monkeypatch):
+    capabilities = utils.sqlite_capabilities()
+    assert sqlite3.sqlite_version_info == capabilities.version
+    assert capabilities.max_variables >= 999
+    assert utils.best_fts_version() == capabilities.fts_versions[0]
+    # Probed once, then reused
+    monkeypatch.setattr(utils.sqlite3, "connect", None)
+    assert capabilities is utils.sqlite_capabilities()
+    assert capabilities.fts_versions[0] == utils.best_fts_version()
+
+
+def test_delete_rows_in_batches(monkeypatch):
+    monkeypatch.setattr(
+        utils,
+        "_sqlite_capabilities",
+        utils.sqlite_capabilities()._replace(max_variables=2),
+    )
+    conn = sqlite3.connect(":memory:")
+    conn.execute("create table t (name text)")
+    conn.executemany("insert into t values (?)", [(str(i),) for i in range(6)])
+    utils.delete_rows(conn, "t", "name", ["0", "1", "2", "4", "5"])
+    assert [("3",)] == conn.execute("select name from t").fetchall()
+
+
+def test_lookup_table_ids_for_values():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(TEST_TABLES)
+    conn.execute("insert into foo (value) values ('Owen')")
+    lookup_table = utils.LookupTable(conn, "foo", "value", False)
+    series = pd.Series(["Terry", None, "Owen", 1.0, "Terry", 2.5, 1])
+    ids = lookup_table.ids_for_values(series)
+    assert [2.0, None, 1.0, 3.0, 2.0, 4.0, 3.0] == [
+        None if pd.isnull(id) else id for id in ids
+    ]
+    assert [(1, "Owen"), (2, "Terry"), (3, "1"), (4, "2.5")] == conn.execute(
+        "select id, value from foo"
+    ).fetchall()
+    # Values resolved in bulk match those from the row-by-row method
+    assert [lookup_table.id_for_value(v) for v in series] == [
+        None if pd.isnull(id) else id for id in ids
+    ]
+
+
+def test_lookup_table_preloads_existing_values():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(TEST_TABLES)
+    conn.executemany(
+        "insert into foo (value) values (?)", [("Owen",), ("Terry",), ("Owen",)]
+    )
+    lookup_table = utils.LookupTable(conn, "foo", "value", False)
+    assert lookup_table.complete
+    assert {"Owen": 1, "Terry": 2} == lookup_table.cache
+    queries = []
+    conn.set_trace_callback(queries.append)
+    ids = lookup_table.ids_for_values(pd.Series(["Terry", "Cleo", "Owen"]))
+    assert [2, 4, 1] == list(ids)
+    assert not any("_csvs_to_sqlite_values" in sql for sql in queries)
+    assert (4, "Cleo") == conn.execute("select * from foo where id = 4").fetchone()
+    assert [] == utils.existing_indexes(conn, "foo")
+
+
+def test_lookup_table_indexes_values_that_do_not_fit_in_memory():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(TEST_TABLES)
+    conn.execute("insert into foo (value) values ('Owen')")
+    lookup_table = utils.LookupTable(conn, "foo", "value", False, memory_budget=100)
+    assert not lookup_table.complete
+    assert [["value"]] == utils.existing_indexes(conn, "foo")
+    assert [1, 2] == list(lookup_table.ids_for_values(pd.Series(["Owen", "Terry"])))
+    # A new table stops caching everything once it outgrows the budget
+    lookup_table = utils.LookupTable(conn, "bar", "value", False, memory_budget=300)
+    assert lookup_table.complete
+    ids = lookup_table.ids_for_values(pd.Series(["a", "b", "c", "a"]))
+    assert [1, 2, 3, 1] == list(ids)
+    assert not lookup_table.complete
+    assert [["value"]] == utils.existing_indexes(conn, "bar")
+    assert 3 == lookup_table.id_for_value("c")
+    # The value index is UNIQUE, unless the table already repeats values
+    assert [1] == [row[2] for row in conn.execute("PRAGMA index_list(bar)")]
+    conn.execute("create table baz (id integer primary key, value text)")
+    conn.execute("insert into baz (value) values ('Owen'), ('Owen')")
+    utils.LookupTable(conn, "baz", "value", False, memory_budget=100)
+    assert [0] == [row[2] for row in conn.execute("PRAGMA index_list(baz)")]
+
+
+def test_lookup_cache():
+    cache = utils.LookupCache(max_entries=20)
+    for i in range(20):
+        cache[str(i)] = i
+    assert (20, 0) == (len(cache), cache.evictions)
+    cache["20"] = 20
+    # The oldest tenth are dropped to make room
+    assert ["2", "3"] == list(cache)[:2]
+    assert (19, 2) == (len(cache), cache.evictions)
+    assert 20 == cache["20"]
+    with pytest.raises(KeyError):
+        cache["0"]
+    assert (1, 1) == (cache.hits, cache.misses)
+    cache = utils.LookupCache(max_memory=10 * (utils.LOOKUP_ENTRY_OVERHEAD + 1))
+    for i in range(10):
+        cache[str(i)] = i
+    assert not cache.fits(1, utils.LOOKUP_ENTRY_OVERHEAD + 1)
+    assert 0 == cache.evictions
+
+
+def test_compact_dataframe():
+    df = pd.DataFrame(
+        {
+            "ints": [1, 2, 300, 4, 5],
+            "floats": [1.5, None, 3.25, 4.0, 5.0],
+            "precise": [0.1, 0.2, 0.3, 0.4, 0.5],
+            "repeated": ["a", "b", "a", None, "a"],
+            "distinct": ["a", "b", "c", "d", "e"],
+            "mixed": ["a", 1, "a", "a", "a"],
+        }
+    )
+    expected = {column: utils._sqlite_values(df[column]) for column in df}
+    utils.compact_dataframe(df)
+    assert "int16" == df["ints"].dtype
+    assert "float32" == df["floats"].dtype
+    assert "float64" == df["precise"].dtype
+    assert "category" == df["repeated"].dtype
+    assert "category" != df["distinct"].dtype
+    assert "object" == df["mixed"].dtype
+    assert expected == {column: utils._sqlite_values(df[column]) for column in df}
+
+
+def test_lookup_table_ids_for_categorical_values():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(TEST_TABLES)
+    conn.execute("insert into foo (value) values ('Owen')")
+    lookup_table = utils.LookupTable(conn, "foo", "value", False)
+    series = pd.Series(["Terry", None, "Owen", "Terry"], dtype="category")
+    ids = lookup_table.ids_for_values(series)
+    assert [2.0, None, 1.0, 2.0] == [None if pd.isna(id) else id for id in ids]
+    assert [2, 1] == lookup_table.ids_for_values(
+        pd.Series(["Terry", "Owen"], dtype="category")
+    ).tolist()
+
+
+def test_parse_dates():
+    series = pd.Series(
+        ["2017-05-03", "2017-05-04", None, "2017-05-03", "10pm on May 3 2017"]
+    )
+    parsed, stats = utils.parse_dates(series, [], force_date=True)
+    assert ["2017-05-03", "2017-05-04", None, "2017-05-03", "2017-05-03"] == [
+        None if pd.isnull(v) else v for v in parsed
+    ]
+    # Only "10pm on May 3 2017" should have needed dateparser
+    assert (3, 1) == stats
+
+
+def test_parse_dates_day_first_ambiguous_values_use_dateparser():
+    series = pd.Series(["30/04/2005", "13/05/2005", "04/05/2005"])
+    parsed, stats = utils.parse_dates(series, [], sample_size=2)
+    # dateparser reads 04/05/2005 month first
+    assert [
+        "2005-04-30T00:00:00",
+        "2005-05-13T00:00:00",
+        "2005-04-05T00:00:00",
+    ] == list(parsed)
+    assert (3, 1) == stats
+
+
+@pytest.mark.parametrize(
+    "value,date_format", [("3 May", "%d %B"), ("May 2017", "%B %Y")]
+)
+def test_parse_dates_incomplete_formats_use_dateparser(value, date_format):
+    parsed, stats = utils.parse_dates(pd.Series([value]), [date_format])
+    expected = dateparser.parse(value, date_formats=[date_format])
+    assert [expected.isoformat()] == list(parsed)
+    assert (1, 1) == stats
+
+
+def test_detect_encoding(tmpdir):
+    utf8 = tmpdir / "utf8.csv"
+    utf8.write_binary("name\nTerry\nZo\u00eb\n".encode("utf8"))
+    latin1 = tmpdir / "latin1.csv"
+    # Only the very last line is not valid UTF-8
+    latin1.write_binary(("name\n" + "Terry\n" * 1000 + "Zo\u00eb\n").encode("latin-1"))
+    assert "utf8" == utils.detect_encoding(str(utf8), ("utf8", "latin-1"))
+    assert "latin-1" == utils.detect_encoding(
+        str(latin1), ("utf8", "latin-1"), sample_size=100
+    )
+    assert utils.detect_encoding("https://example.com/x.csv", ("utf8",)) is None
+
+
+def test_load_csv_reads_file_once_with_detected_encoding(tmpdir, monkeypatch):
+    latin1 = tmpdir / "latin1.csv"
+    latin1.write_binary(("name\n" + "Terry\n" * 1000 + "Zo\u00eb\n").encode("latin-1"))
+    calls = []
+    read_csv = pd.read_csv
+
+    def counting_read_csv(*args, **kwargs):
+        calls.append(kwargs["encoding"])
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(utils.pd, "read_csv", counting_read_csv)
+    df = utils.load_csv(str(latin1), ",", False, 0, None)
+    assert ["latin-1"] == calls
+    assert "latin-1" == df.attrs["encoding"]
+    assert "Zo\u00eb" == df.name.iloc[-1]
+
+
+def test_incremental_import_reads_no_further_than_recorded(tmpdir):
+    path = tmpdir / "test.csv"
+    path.write_binary(b"a,b\n1,2\n3,")
+    conn = sqlite3.connect(":memory:")
+    utils.ensure_files_table(conn)
+    csvs, records, _, _ = utils.plan_incremental_import(
+        conn, {"test": str(path)}, append_only=True
+    )
+    # Written after the import was planned
+    with open(str(path), "ab") as fp:
+        fp.write(b"4\n5,6\n")
+    df = utils.load_csv(csvs["test"], ",", False, 0, None)
+    assert [[1, 2]] == df.values.tolist()
+    assert 8 == records["test"]["offset"]